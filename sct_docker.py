@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 vi:noet
 
-import sys, io, os, re, logging, time, datetime, shutil
+import sys, io, os, re, json, logging, time, datetime, shutil, collections
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +46,261 @@ def check_exe(name):
                 return exe_file
 
 
+# Marker line delimiting the package installation phases in the generated
+# fragment; stripped from the output, used as a boundary by compact mode.
+_phase_marker = "#phase:"
+
+# Sourced by shells (login, interactive bash, entrypoint) to size the thread
+# pools of the numeric libraries to the CPUs the container may use (cpuset,
+# CFS quota of cgroup v2 or v1), unless SCT_THREADS or the variables are set
+threads_path = "/etc/profile.d/sct-threads.sh"
+
+threads_variables = (
+ "OMP_NUM_THREADS",
+ "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+ "MKL_NUM_THREADS",
+ "OPENBLAS_NUM_THREADS",
+)
+
+threads_script = (
+ "sct_threads=${SCT_THREADS:-}",
+ "if [ -z \"$sct_threads\" ]; then",
+ " sct_threads=$(nproc 2>/dev/null || echo 1)",
+ " if [ -r /sys/fs/cgroup/cpu.max ]; then read sct_quota sct_period < /sys/fs/cgroup/cpu.max",
+ " elif [ -r /sys/fs/cgroup/cpu/cpu.cfs_quota_us ]; then sct_quota=$(cat /sys/fs/cgroup/cpu/cpu.cfs_quota_us); sct_period=$(cat /sys/fs/cgroup/cpu/cpu.cfs_period_us); fi",
+ " if [ -n \"$sct_quota\" ] && [ \"$sct_quota\" != max ] && [ \"$sct_quota\" -gt 0 ]; then",
+ "  sct_quota=$(( (sct_quota + sct_period - 1) / sct_period ))",
+ "  if [ \"$sct_quota\" -lt \"$sct_threads\" ]; then sct_threads=$sct_quota; fi",
+ " fi",
+ "fi",
+) + tuple("export {0}=${{{0}:-$sct_threads}}".format(x) for x in threads_variables) + (
+ "unset sct_threads sct_quota sct_period",
+)
+
+# Entrypoint of the images: services are only started when asked, or for
+# an interactive shell (no command given; sshd in the images configured
+# for ssh), and other commands are run directly, without the interactive
+# shell initialization, but with the threads set (see `threads_path`)
+entrypoint_path = "/usr/local/bin/sct-entrypoint"
+
+# Created by the entrypoint once the services are started
+ready_path = "/tmp/sct-ready"
+
+# Not precompiled: test suites, whose data has files that don't compile
+compileall_excluded = r"/(tests?|lib2to3)/"
+
+# First line of the Dockerfiles using `RUN --mount`, which older BuildKit
+# versions (Docker 18.09, 19.03) only support with the external frontend
+dockerfile_syntax = "# syntax=docker/dockerfile:1"
+
+# Where the datasets are mounted from a data image (see `generate_data()`)
+shared_data_path = "/home/sct/sct-data"
+
+# Datasets available offline in the images
+datasets = ("sct_example_data", "sct_testing_data")
+
+entrypoint_script = (
+ "#!/bin/sh",
+ "# SCT_SSHD=1: start sshd (default without a command)",
+ "# SCT_QC=<directory>: serve QC reports on port 8888",
+ ". {}".format(threads_path),
+ "[ $# = 0 ] && : ${SCT_SSHD:=1}",
+ "if [ \"$SCT_SSHD\" = 1 ] && [ -x /usr/sbin/sshd ]; then sudo mkdir -p /run/sshd && sudo /usr/sbin/sshd; fi",
+ "if [ -n \"$SCT_QC\" ]; then (cd \"$SCT_QC\" && { \"$SCT_DIR/python/bin/python\" -m http.server 8888 || \"$SCT_DIR/python/bin/python\" -m SimpleHTTPServer 8888; } > /dev/null 2>&1 &); fi",
+ "touch {}".format(ready_path),
+ "[ $# = 0 ] && exec /bin/bash",
+ "exec \"$@\"",
+)
+
+_pm_re = re.compile(r"^RUN (?P<sudo>sudo )?(?P<pm>apt-get|yum|dnf) (?P<op>install|update|search)(?P<args>.*)$")
+
+
+def pm_transaction(pm, packages, sudo="", upgrade=False):
+    """
+    Build a single package manager transaction: refresh the index,
+    install, and clean the cache so that it does not end up in the layer.
+
+    :param pm: package manager (apt-get, yum, dnf)
+    :param packages: list of packages
+    :param sudo: command prefix (eg. "sudo ")
+    :param upgrade: whether to upgrade installed packages first (yum/dnf)
+    :return: RUN instruction
+    """
+    steps = []
+    if pm == "apt-get":
+        steps.append("{}apt-get update --fix-missing".format(sudo))
+    elif upgrade:
+        steps.append("{}{} update -y".format(sudo, pm))
+    # Repository packages must be installed before what they provide
+    repos = [x for x in packages if x.endswith("-release") or "-release-" in x]
+    packages = [x for x in packages if x not in repos]
+    for pkgs in (repos, packages):
+        if pkgs:
+            steps.append("{}{} install -y {}".format(sudo, pm, " ".join(pkgs)))
+    if pm == "apt-get":
+        steps.append("{}rm -rf /var/lib/apt/lists/*".format(sudo))
+    else:
+        steps.append("{}{} clean all".format(sudo, pm))
+    return "RUN " + " && ".join(steps)
+
+
+def compact_dockerfile(lines):
+    """
+    Merge the package manager invocations of each phase into one transaction.
+
+    Consecutive `RUN [sudo] apt-get/yum/dnf install` lines of a phase (comments,
+    blank lines and ENV in between are allowed) become one RUN, index updates
+    are folded into it, and `search` diagnostics are dropped.
+
+    :param lines: Dockerfile lines, including phase markers
+    :return: Dockerfile lines, without phase markers
+    """
+    out = list()
+    pending = dict()
+
+    def flush():
+        if not pending:
+            return
+        out.extend(pending["notes"])
+        if pending["packages"] or pending["upgrade"]:
+            out.append(pm_transaction(pending["pm"], pending["packages"],
+             sudo=pending["sudo"], upgrade=pending["upgrade"]))
+        out.extend(pending["env"])
+        pending.clear()
+
+    for line in lines:
+        if line.startswith(_phase_marker):
+            flush()
+            continue
+
+        m = _pm_re.match(line)
+        if m is not None:
+            sudo, pm = m.group("sudo") or "", m.group("pm")
+            if pending and (pending["pm"], pending["sudo"]) != (pm, sudo):
+                flush()
+            if not pending:
+                pending.update(pm=pm, sudo=sudo, packages=[], upgrade=False, notes=[], env=[])
+            op = m.group("op")
+            if op == "install":
+                for package in m.group("args").split():
+                    if package != "-y" and package not in pending["packages"]:
+                        pending["packages"].append(package)
+            elif op == "update" and pm != "apt-get":
+                pending["upgrade"] = True
+            continue
+
+        if pending and (line == "" or line.startswith("#")):
+            pending["notes"].append(line)
+        elif pending and line.startswith("ENV "):
+            pending["env"].append(line)
+        else:
+            flush()
+            out.append(line)
+
+    flush()
+    return out
+
+
+def cache_mount_dockerfile(lines, distro):
+    """
+    Use BuildKit cache mounts for the package manager, pip and conda
+    downloads, so that they are kept between builds of the same distro.
+
+    The package managers are configured to keep their downloads, and the
+    cache cleanups of compact mode are removed, as they would empty the
+    cache mounts.
+
+    :param lines: Dockerfile lines
+    :param distro: Distribution, used to name the caches
+    :return: Dockerfile lines
+    """
+    prefix = "sct-{}".format(re.sub(r"[:/@]", "-", distro))
+
+    if distro.startswith(("debian", "ubuntu")):
+        pm_targets = ("/var/cache/apt", "/var/lib/apt/lists")
+        keep = "rm -f /etc/apt/apt.conf.d/docker-clean && echo 'Binary::apt::APT::Keep-Downloaded-Packages \"true\";' > /etc/apt/apt.conf.d/keep-cache"
+    elif distro.startswith("fedora"):
+        pm_targets = ("/var/cache/dnf",)
+        keep = "echo keepcache=True >> /etc/dnf/dnf.conf"
+    else:
+        pm_targets = ("/var/cache/yum",)
+        keep = "sed -i -e 's/^keepcache=0/keepcache=1/' /etc/yum.conf"
+
+    def mount(target, uid=0):
+        return "--mount=type=cache,id={}{},target={},sharing=locked{}".format(
+         prefix, target.replace("/", "-"), target, ",uid={0},gid={0}".format(uid) if uid else "")
+
+    pm_mounts = " ".join(mount(x) for x in pm_targets)
+    # the sct user, created first
+    pip_mount = mount("/home/sct/.cache/pip", uid=1000)
+    conda_mount = mount("/home/sct/.cache/conda/pkgs", uid=1000)
+
+    out = [dockerfile_syntax]
+    for line in lines:
+        if not line.startswith("RUN "):
+            out.append(line)
+            if line.startswith("FROM "):
+                out.append("RUN {}".format(keep))
+            elif line == "USER sct":
+                # or the mount points' parents would be owned by root
+                out.append("RUN mkdir -p /home/sct/.cache/pip /home/sct/.cache/conda/pkgs")
+            continue
+
+        cmd = line[len("RUN "):]
+        mounts = list()
+        if re.search(r"\b(apt-get|yum|dnf) (install|update)", cmd):
+            mounts.append(pm_mounts)
+            cmd = re.sub(r" && (sudo )?rm -rf /var/lib/apt/lists/\*(?= &&|$)", "", cmd)
+            cmd = cmd.replace("rm -rf /var/lib/apt/lists/* ", "rm -rf ")
+            cmd = re.sub(r" && (sudo )?(yum|dnf) clean all", "", cmd)
+        if "${PIP}" in cmd or "install_sct" in cmd:
+            mounts.append(pip_mount)
+        if "install_sct" in cmd:
+            mounts.append(conda_mount)
+            cmd = "export CONDA_PKGS_DIRS=/home/sct/.cache/conda/pkgs && " + cmd
+
+        if mounts:
+            out.append("RUN {} {}".format(" ".join(mounts), cmd))
+        else:
+            out.append(line)
+    return out
+
+
+def dockerfile_layers(path):
+    """
+    List the instructions of a Dockerfile that create a filesystem layer
+    :param path: Dockerfile or directory containing it
+    :return: list of instruction lines
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "Dockerfile")
+    with io.open(path, "r", encoding="utf-8") as f:
+        return [x.strip() for x in f if x.startswith(("RUN ", "COPY ", "ADD "))]
+
+
+mirror_kinds = collections.OrderedDict((
+ ("proxy", "HTTP(S) proxy for everything (eg. squid)"),
+ ("apt", "HTTP proxy for apt (eg. apt-cacher-ng)"),
+ ("dnf", "yum/dnf mirror, with the upstream layout"),
+ ("pip", "pip index (eg. devpi)"),
+ ("conda", "conda channel alias"),
+))
+
+
+def parse_mirror(spec):
+    """
+    Parse a mirror specification, for command-line tools
+    :param spec: "KIND=URL" or "KIND=URL,CA_FILE"
+    :return: (kind, (url, ca))
+    """
+    kind, sep, value = spec.partition("=")
+    if not sep or kind not in mirror_kinds:
+        raise ValueError("Invalid mirror {!r}, expected KIND=URL[,CA_FILE] with KIND in {}".format(
+         spec, ", ".join(mirror_kinds)))
+    url, sep, ca = value.partition(",")
+    return kind, (url, ca or None)
+
+
 def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
              install_python=True,
              install_compilers=False,
@@ -54,19 +309,58 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
              install_fsl=False,
              configure_ssh=True,
              verbose=True,
-             proxy=False,
+             mirrors=None,
+             compact=False,
+             multistage=False,
+             cache_mounts=False,
+             artifacts=None,
+             precompile=False,
+             shared_data=False,
              ):
     """
     :param distro: Distribution (Docker specification)
     :param version: SCT version
     :param commands: Commands to run as part of build
+    :param mirrors: Local proxy/mirrors to use during the build, as a dict
+                    of kind (see `mirror_kinds`) to URL or (URL, CA file)
+    :param compact: Group the package installations of each phase into
+                    one transaction (see `compact_dockerfile()`)
+    :param multistage: When building things (fsleyes, compilers, fsl),
+                       do it in a builder stage and only copy the results
+                       and the libraries they need in the final image
+    :param cache_mounts: Keep the downloads in BuildKit cache mounts
+                         (see `cache_mount_dockerfile()`); the Dockerfile
+                         then needs BuildKit to be built
+    :param artifacts: Local files to use instead of downloading them in
+                      the image, as a dict of "sct" (source tarball) or
+                      dataset name to path (see sct_docker_artifacts);
+                      they are bind mounted in the build, so that they
+                      don't end up in a layer, and the Dockerfile then
+                      needs BuildKit to be built
+    :param precompile: Compile the installed Python modules to bytecode,
+                       and create the caches made by a first run of SCT
+                       (fonts, matplotlib), so that commands start faster
+    :param shared_data: Don't put the datasets in the image, but link
+                        them to `shared_data_path`, where a data volume
+                        (see `generate_data()`) is to be mounted
     :returns: name
     """
 
+    if shared_data and artifacts:
+        # They are in the data image
+        artifacts = dict((k, v) for k, v in artifacts.items() if k not in datasets)
+
+    # What the image depends on, besides the Dockerfile (see sct_docker_build)
+    inputs = dict((k, v) for k, v in locals().items() if k not in ("name", "verbose"))
+
     frag = """
     FROM {distro}
     """.strip().format(**locals())
 
+    multistage = multistage and (install_fsleyes or install_compilers or install_fsl)
+    if multistage:
+        frag += " AS builder"
+
     # This docker variable will be needed to strip the unwanted spaces at the end. We just initialize it here. 
     docker = ''
 
@@ -74,6 +368,29 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
         orga, distro = distro.split("/")
         distro = "%s@%s" % (distro, orga)
 
+    frag += "\n" + _phase_marker + "base"
+
+    mirrors = dict((k, (v, None) if isinstance(v, str) else tuple(v)) for k, v in (mirrors or dict()).items())
+    for kind in mirrors:
+        if kind not in mirror_kinds:
+            raise ValueError("Unknown mirror kind {} (expected one of {})".format(kind, ", ".join(mirror_kinds)))
+
+    cas = dict()
+    for url, ca in mirrors.values():
+        if ca is not None and ca not in cas:
+            with io.open(ca, "r", encoding="utf-8") as f:
+                cas[ca] = f.read().strip().replace("\n", "\\n")
+
+    if "apt" in mirrors and distro.startswith(("debian", "ubuntu")):
+        frag += "\n" + """
+        RUN echo 'Acquire::http::Proxy "{}";' > /etc/apt/apt.conf.d/01sct-mirror
+        """.strip().format(mirrors["apt"][0])
+
+    if "dnf" in mirrors and distro.startswith(("fedora", "centos")):
+        frag += "\n" + """
+        RUN sed -i.sct-orig -e 's/^metalink=/#metalink=/' -e 's/^mirrorlist=/#mirrorlist=/' -e 's|^#baseurl=http://download.example/pub/fedora/linux|baseurl={url}|' -e 's|^#baseurl=http://mirror.centos.org/centos|baseurl={url}|' /etc/yum.repos.d/*.repo
+        """.strip().format(url=mirrors["dnf"][0])
+
     if distro.startswith(("debian", "ubuntu")):
         frag += "\n" + """
         RUN echo 'debconf debconf/frontend select Noninteractive' | debconf-set-selections
@@ -96,7 +413,7 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
         RUN dnf install -y curl
         """.strip()
 
-    if proxy:
+    if cas:
         if distro.startswith(("debian", "ubuntu")):
             frag += "\n" + """
             RUN apt-get install -y ca-certificates
@@ -118,12 +435,12 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
             ENV CERTECHO="echo -e"
             """.strip()
 
-        # Use CA certificate for local ssl_bump proxy
-        frag += "\n" + """
-        RUN ${CERTECHO} "-----BEGIN CERTIFICATE-----\\nMIIDyTCCArGgAwIBAgIJAKF6rNGHC1AeMA0GCSqGSIb3DQEBCwUAMHsxCzAJBgNV\\nBAYTAkNBMQ8wDQYDVQQIDAZRdWViZWMxETAPBgNVBAcMCE1vbnRyZWFsMQ0wCwYD\\nVQQKDARub25lMRQwEgYDVQQDDAt6b3VnbG91Yi5ldTEjMCEGCSqGSIb3DQEJARYU\\nY0otc3F1aWRAem91Z2xvdWIuZXUwHhcNMTkwNzI3MjMwMzA1WhcNMjAwNzI2MjMw\\nMzA1WjB7MQswCQYDVQQGEwJDQTEPMA0GA1UECAwGUXVlYmVjMREwDwYDVQQHDAhN\\nb250cmVhbDENMAsGA1UECgwEbm9uZTEUMBIGA1UEAwwLem91Z2xvdWIuZXUxIzAh\\nBgkqhkiG9w0BCQEWFGNKLXNxdWlkQHpvdWdsb3ViLmV1MIIBIjANBgkqhkiG9w0B\\nAQEFAAOCAQ8AMIIBCgKCAQEAwyt/Iv5PE6hbWngoIDAY3zKh1V9luuyfweSs4/tg\\nz5btY1j+PqMOl2MpcYsVW7+HwqJq5E6jn2qMPA94XwfnylQqUL/rpC+90Lt964k0\\nVhQi5FhQkyW3R5WaN03cn2xyj4wsiSyPDP61274DpkymhXflCYsKp0Ta3C8VUV8U\\nPqEpzWwPdfi4Ej5XFidXGKdeE6JZftypFK2wyIA+cwbZE/MP7pp6BvoyIJsV5duq\\njF9ByhAtdka8B8IzBVtp87HjeT7MHAjHtrzddaW/s8Dfnr4HkQb+t2ZBDxlUDvWY\\n0jERTcToobfXU3TjRMPriQnbb4cDfbbbqUKucUw2c8aXaQIDAQABo1AwTjAdBgNV\\nHQ4EFgQU9PnADlRycQCVXhOaGre9oF6WrHswHwYDVR0jBBgwFoAU9PnADlRycQCV\\nXhOaGre9oF6WrHswDAYDVR0TBAUwAwEB/zANBgkqhkiG9w0BAQsFAAOCAQEAFPlT\\nZBs2zOI7CiNixIO7G3QFQKRUheFAQMll0w9FXQW+3aB7TcKtsu6iR0oIPoXx50G8\\nX1uaxi9CidO98yI1QLvnxZlumvX9peRooFryyUGrzN8Fiy8hdTtuS9KNzWDgVApj\\nIcqYr53RM/jzIS4AHRwaau8wrWaoiys3wvHKhNL9EH5I7WzKHS0elrjW5Mn4Ew0i\\n3gQ+rQ5VoL0Ljm8GA2EJQ9gzecdvShMuXAMFokte0BRvYwHEM4+mkGVoTdPrN/pf\\n2xnk91vA0AQnYbrottxGIpL9WwRSjyz8qQv/Nw8S2ohauJz3aDXcUNXOCm6RZ7Vl\\noSqg2oypaL1o9/b20g==\\n-----END CERTIFICATE-----" > ${CERTDIR}/zougloub.eu.pem
-        RUN cat ${CERTDIR}/zougloub.eu.pem
-        ENV https_proxy=http://zougloub.eu:3128 http_proxy=http://zougloub.eu:3128
-        """.strip()
+        # Use CA certificates of the mirrors (eg. for a local ssl_bump proxy)
+        for kind, (url, ca) in sorted(mirrors.items()):
+            if ca is not None:
+                frag += "\n" + """
+                RUN ${{CERTECHO}} "{pem}" > ${{CERTDIR}}/sct-mirror-{kind}.pem
+                """.strip().format(kind=kind, pem=cas[ca])
 
         if distro.startswith(("debian", "ubuntu")):
             frag += "\n" + """
@@ -141,6 +458,26 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
             RUN update-ca-trust enable
             """.strip()
 
+    # Build arguments rather than environment, so that they don't stay in the
+    # image; the proxy is given at build time (see `sct_docker_build.proxy_args()`),
+    # as predefined arguments aren't shown in the image history either
+    for kind, variables in (
+     ("pip", ("PIP_INDEX_URL",)),
+     ("conda", ("CONDA_CHANNEL_ALIAS",)),
+     ):
+        if kind in mirrors:
+            frag += "\n" + "ARG " + " ".join("{}={}".format(x, mirrors[kind][0]) for x in variables)
+
+    for kind, variables in (
+     ("proxy", ("REQUESTS_CA_BUNDLE",)),
+     ("pip", ("PIP_CERT",)),
+     ("conda", ("CONDA_SSL_VERIFY",)),
+     ):
+        if kind in mirrors and mirrors[kind][1] is not None:
+            frag += "\n" + "ARG " + " ".join("{}=${{CERTDIR}}/sct-mirror-{}.pem".format(x, kind) for x in variables)
+
+    frag += "\n" + _phase_marker + "gui"
+
     if distro.startswith(("debian", "ubuntu")):
         frag += "\n" + """
         RUN apt-get install -y sudo
@@ -186,6 +523,8 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
         RUN dnf install -y compat-libstdc++-33 libstdc++
         """.strip()
 
+    frag += "\n" + _phase_marker + "compilers"
+
     if install_fsleyes or install_fsl or install_compilers:
         if distro.startswith(("debian", "ubuntu")):
             frag += "\n" + """
@@ -204,6 +543,8 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
             RUN yum install -y redhat-rpm-config gcc "gcc-c++" make
             """.strip()
 
+    frag += "\n" + _phase_marker + "fsleyes"
+
     if install_fsleyes:
         if distro.startswith(("debian", "ubuntu")):
             frag += "\n" + """
@@ -264,6 +605,8 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
             RUN yum install -y webkitgtk3-devel webkitgtk-devel
             """.strip()
 
+    frag += "\n" + _phase_marker + "fsl"
+
     if install_fsl:
         if distro.startswith("fedora"):
             frag += "\n" + """
@@ -280,6 +623,8 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
             RUN apt-get install -y libexpat1-dev libx11-dev zlib1g-dev libgl1-mesa-dev
             """.strip()
 
+    frag += "\n" + _phase_marker + "user"
+
     frag += "\n" + """
     RUN useradd -ms /bin/bash sct
     RUN echo "sct ALL=(ALL) NOPASSWD: ALL" >> /etc/sudoers
@@ -290,11 +635,7 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
     EXPOSE 22
     """.strip()
 
-    if proxy:
-        frag += "\n" + """
-    ENV https_proxy=http://zougloub.eu:3128 http_proxy=http://zougloub.eu:3128 HTTPS_PROXY=http://zougloub.eu:3128 HTTP_PROXY=http://zougloub.eu:3128
-    ENV REQUESTS_CA_BUNDLE=${CERTDIR}/zougloub.eu.pem
-    """.strip()
+    frag += "\n" + _phase_marker + "tools"
 
     if install_tools:
 
@@ -328,13 +669,15 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
         RUN sudo apt-get install -y git
         """.strip()
 
-    if proxy:
+    if "proxy" in mirrors and mirrors["proxy"][1] is not None:
 
         if distro in ("debian:8",):
             frag += "\n" + """
-            RUN git config --global http.sslCAInfo /etc/ssl/certs/zougloub.eu.pem
+            RUN git config --global http.sslCAInfo /etc/ssl/certs/sct-mirror-proxy.pem
             """.strip()
 
+    frag += "\n" + _phase_marker + "python"
+
     if install_python:
 
         if distro in ("debian:8", "ubuntu:14.04"):
@@ -400,31 +743,74 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
         ENV BASH_ENV ~/.bashenv
         """.strip()
 
+    frag += "\n" + _phase_marker + "sct"
+
+    artifacts = artifacts or dict()
+
+    def artifact(kind):
+        """
+        :return: RUN instruction prefix, and path of an artifact in the image
+        """
+        filename = os.path.basename(artifacts[kind])
+        return "RUN --mount=type=bind,source=artifacts,target=/tmp/artifacts ", "/tmp/artifacts/" + filename
+
+    if "sct" in artifacts:
+        run, path = artifact("sct")
+        get_sct = "tar xzf {}".format(path)
+    else:
+        run = "RUN "
+        get_sct = "curl --location https://github.com/neuropoly/spinalcordtoolbox/archive/{}.tar.gz | gunzip | tar x".format(version)
+        if not re.match(r"^v?\d+\.\d+\.\d+(-beta\.\d+)?$", version):
+            # Commit of the branch, given by sct_docker_build, so that the
+            # download isn't cached when the branch moves
+            frag += "\n" + """
+            ARG SCT_REVISION
+            """.strip()
+
     m = re.match(r"^(?P<v>v)?(?P<pv>\d+\.\d+\.\d+(-beta\.\d+)?)$", version)
     if m is not None:
         dirv = m.group("pv")
         dl_fn = version  # if version.startswith("v") else "v{}".format(version)
         sct_dir = "/home/sct/sct_{}".format(dirv)
         frag += "\n" + """
-        RUN curl --location https://github.com/neuropoly/spinalcordtoolbox/archive/{dl_fn}.tar.gz | gunzip | tar x && cd spinalcordtoolbox-{dirv} && yes | ./install_sct && cd - && rm -rf spinalcordtoolbox-{dirv}
+        {run}{get_sct} && cd spinalcordtoolbox-{dirv} && yes | ./install_sct && cd - && rm -rf spinalcordtoolbox-{dirv}
         """.strip().format(**locals())
     else:
         dirv = version
         sct_dir = "/home/sct/sct_dev"
         frag += "\n" + """
-        RUN curl --location https://github.com/neuropoly/spinalcordtoolbox/archive/{version}.tar.gz | gunzip | tar x && cd spinalcordtoolbox-{dirv}* && yes | ./install_sct && cd - && rm -rf spinalcordtoolbox-{dirv}*
+        {run}{get_sct} && cd spinalcordtoolbox-{dirv}* && yes | ./install_sct && cd - && rm -rf spinalcordtoolbox-{dirv}*
         """.strip().format(**locals())
 
     frag += "\n" + """
     ENV SCT_DIR {sct_dir}
+    ENV PATH {sct_dir}/bin:${{PATH}}
     """.strip().format(**locals())
 
     frag += "\n" + """
     # Get data for offline use
-    RUN bash -i -c "sct_download_data -d sct_example_data"
-    RUN bash -i -c "sct_download_data -d sct_testing_data"
     """.strip()
 
+    # Where sct_download_data would have put the datasets
+    data_links = """
+    RUN for d in {datasets}; do ln -sfn {path}/$d /home/sct/$d; done
+    """.strip().format(datasets=" ".join(datasets), path=shared_data_path)
+
+    if shared_data:
+        frag += "\n" + data_links
+
+    for dataset in () if shared_data else datasets:
+        if dataset in artifacts and install_python:
+            # Extracted where sct_download_data puts it (the working directory)
+            run, path = artifact(dataset)
+            frag += "\n" + """
+            {run}cd $(mktemp -d) && ${{PYTHON}} -m zipfile -e {path} . && set -- * && if [ $# = 1 ] && [ -d "$1" ]; then mv "$1" /home/sct/{dataset}; else mkdir /home/sct/{dataset} && mv * /home/sct/{dataset}/; fi && rm -rf $PWD
+            """.strip().format(**locals())
+        else:
+            frag += "\n" + """
+            RUN sct_download_data -d {}
+            """.strip().format(dataset)
+
     if install_fsleyes:
 
         if distro in ("debian:8", "ubuntu:14.04"):
@@ -445,15 +831,9 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
             frag += "\n" + """
             """.strip()
 
-        if proxy and False:
-            # unneeded due to REQUESTS_CA_BUNDLE
-            frag += "\n" + """
-            ENV PIP ${PYTHON} -m pip --cert ${CERTDIR}/zougloub.eu.pem
-            """.strip()
-        else:
-            frag += "\n" + """
-            ENV PIP ${PYTHON} -m pip
-            """.strip()
+        frag += "\n" + """
+        ENV PIP ${PYTHON} -m pip
+        """.strip()
 
         if distro in ("centos:7",):
             # https://linuxize.com/post/how-to-install-python-3-on-centos-7/
@@ -462,6 +842,8 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
             """.strip()  # TODO
 
         frag += "\n" + """
+        # parallelism of compilations, lowered when they run out of memory
+        ARG MAKEFLAGS
         # can't use system packages as they'd get updated
         RUN ${PIP} install --user --upgrade pathlib2
         RUN ${PIP} install --user --upgrade pip
@@ -502,6 +884,101 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
         RUN bash -c "cat ~/.bashrc"
         """.strip()
 
+    if multistage:
+        builder = frag
+
+        def phase(start, end=None):
+            return builder[builder.index(_phase_marker + start):builder.index(_phase_marker + end) if end else None]
+
+        sources = ["${HOME}/.local", sct_dir]
+        if install_fsl:
+            sources.append("${FSLDIR}")
+
+        # The interpreter itself, for what the pip installed modules need
+        interpreter = "readlink -f $(command -v ${PYTHON}); " if install_python else ""
+
+        if distro.startswith(("debian", "ubuntu")):
+            owner = "dpkg -S \"$f\" 2>/dev/null | cut -d: -f1"
+        else:
+            owner = "rpm -qf --queryformat '%{NAME}\\n' \"$f\" 2>/dev/null | grep -v ' '"
+
+        frag += "\n" + """
+        # List the packages providing the shared libraries used by what was built
+        RUN ({interpreter}find {sources} -type f -name '*.so*' -print0 | xargs -0 -r ldd 2>/dev/null | awk '$2 == "=>" && $3 ~ /^\\// {{print $3}}') | sort -u | while read f; do {owner}; done | sort -u > ${{HOME}}/runtime-packages.txt
+        """.strip().format(interpreter=interpreter, sources=" ".join(sources), owner=owner)
+
+        frag += "\n" + """
+        FROM {} AS runtime
+        """.strip().format(inputs["distro"])
+
+        frag += "\n" + phase("base", "compilers")
+
+        frag += "\n" + """
+        COPY --from=builder /home/sct/runtime-packages.txt /tmp/
+        """.strip()
+
+        if distro.startswith(("debian", "ubuntu")):
+            frag += "\n" + """
+            RUN {update}xargs -a /tmp/runtime-packages.txt apt-get install -y {python} && rm -rf {lists}/tmp/runtime-packages.txt
+            """.strip().format(
+                # compact mode doesn't keep the package lists around
+                update="apt-get update --fix-missing && " if compact else "",
+                lists="/var/lib/apt/lists/* " if compact else "",
+                python="python3" if install_python else "",
+            )
+
+        else:
+            pm = "dnf" if distro.startswith("fedora") else "yum"
+            frag += "\n" + """
+            RUN if grep -q ^rh- /tmp/runtime-packages.txt; then {pm} install -y centos-release-scl; fi && xargs -r {pm} install -y < /tmp/runtime-packages.txt && {pm} clean all && rm /tmp/runtime-packages.txt
+            """.strip().format(pm=pm)
+
+        frag += "\n" + phase("user", "python")
+
+        frag += "\n" + "\n".join(x.strip() for x in (phase("python", "sct") + phase("sct")).split("\n")
+                                 if x.strip().startswith(("ENV ", "SHELL ")))
+
+        frag += "\n" + """
+        COPY --from=builder --chown=sct:sct /home/sct/.local /home/sct/.local
+        COPY --from=builder --chown=sct:sct /home/sct/.bashrc {bashenv} /home/sct/
+        COPY --from=builder --chown=sct:sct {sct_dir} {sct_dir}
+        """.strip().format(bashenv="/home/sct/.bashenv" if install_python else "", sct_dir=sct_dir)
+
+        if install_fsl:
+            frag += "\n" + """
+            COPY --from=builder --chown=sct:sct /home/sct/fsl /home/sct/fsl
+            """.strip()
+
+        if shared_data:
+            frag += "\n" + data_links
+
+        for dataset in () if shared_data else datasets:
+            frag += "\n" + """
+            COPY --from=builder --chown=sct:sct /home/sct/{0} /home/sct/{0}
+            """.strip().format(dataset)
+
+    if precompile:
+        # The SCT interpreter is the conda environment's one, if any
+        frag += "\n" + """
+        # Precompile the Python modules, and create the caches made on first run
+        RUN sct_py=; for py in ${SCT_DIR}/python/bin/python ${SCT_DIR}/python/envs/*/bin/python; do if [ -x "$py" ]; then sct_py="$py"; "$py" -m compileall -q -x "{exclude}" "${py%/bin/python}/lib" || exit 1; fi; done; for d in ${SCT_DIR}/scripts ${SCT_DIR}/spinalcordtoolbox; do if [ -d "$d" ]; then "${sct_py:-${PYTHON}}" -m compileall -q "$d" || exit 1; fi; done
+        """.strip().replace("{exclude}", compileall_excluded)
+        if install_python:
+            frag += "\n" + """
+            RUN if [ -d ${HOME}/.local/lib ]; then ${PYTHON} -m compileall -q -x "{exclude}" ${HOME}/.local/lib; fi
+            """.strip().replace("{exclude}", compileall_excluded)
+        frag += "\n" + """
+        RUN if command -v fc-cache > /dev/null; then fc-cache; fi && for py in ${SCT_DIR}/python/bin/python ${SCT_DIR}/python/envs/*/bin/python; do if [ -x "$py" ] && ls -d "${py%/bin/python}"/lib/python*/site-packages/matplotlib > /dev/null 2>&1; then MPLBACKEND=Agg "$py" -c "import matplotlib.pyplot" > /dev/null || exit 1; fi; done && sct_check_dependencies -short > /dev/null
+        """.strip()
+
+    frag += "\n" + """
+    # Threads of the numeric libraries, from the CPUs of the container (or SCT_THREADS)
+    RUN printf '%s\\n' {script} | sudo tee {path} > /dev/null && echo ". {path}" >> ${{HOME}}/.bashrc
+    """.strip().format(
+        script=" ".join("'{}'".format(x) for x in threads_script),
+        path=threads_path,
+    )
+
     if commands is not None:
         frag += "\n" + "\n".join(["""RUN bash -i -c '{}'""".format(command) for command in commands])
 
@@ -512,12 +989,26 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
             RUN yes '' | sudo ssh-keygen -q -t ed25519 -f /etc/ssh/ssh_host_ed25519_key
             """.strip()
         frag += "\n" + """
-        # QC connection
-        EXPOSE 8888
-
         RUN echo  X11UseLocalhost no | sudo tee --append /etc/ssh/sshd_config
+        """.strip()
+
+    frag += "\n" + """
+    # QC connection
+    EXPOSE 8888
+
+    RUN printf '%s\\n' {script} | sudo tee {path} > /dev/null && sudo chmod +x {path}
+    HEALTHCHECK --interval=30s --timeout=2s --start-period=1m CMD test -e {ready}
+    ENTRYPOINT ["{path}"]
+    """.strip().format(
+        script=" ".join("'{}'".format(x) for x in entrypoint_script),
+        path=entrypoint_path,
+        ready=ready_path,
+    )
 
-        ENTRYPOINT bash -c 'sudo mkdir -p /run/sshd; sudo /usr/sbin/sshd; /bin/bash'
+    if "apt" in mirrors or "dnf" in mirrors:
+        # Mirrors are only for the build
+        frag += "\n" + """
+        RUN sudo rm -f /etc/apt/apt.conf.d/01sct-mirror; for f in /etc/yum.repos.d/*.sct-orig; do [ -e "$f" ] && sudo mv "$f" "${f%.sct-orig}"; done; true
         """.strip()
 
     frag += "\n" + """
@@ -526,8 +1017,16 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
 
     # We strip leading tab to have a more conventional docker file. We use tab to make the code more Human readable
     # each time we add multiline commands  the .strip function only remove the white space from the first line
-    for x in frag.split('\n'):
-        docker += x.lstrip() + '\n'
+    lines = [x.lstrip() for x in frag.split('\n')]
+    if compact:
+        lines = compact_dockerfile(lines)
+    if cache_mounts:
+        lines = cache_mount_dockerfile(lines, distro)
+    if lines[0] != dockerfile_syntax and any(" --mount=" in x for x in lines):
+        lines = [dockerfile_syntax] + lines
+    for x in lines:
+        if not x.startswith(_phase_marker):
+            docker += x + '\n'
 
     if name is None:
         name = "sct-%s-%s" % (distro.replace(":", "-"), version)
@@ -536,6 +1035,93 @@ def generate(distro="debian:7", version="3.1.1", commands=None, name=None,
         os.makedirs(name)
     with io.open(os.path.join(name, "Dockerfile"), "wb") as f:
         f.write(docker.encode("utf-8"))
+    with io.open(os.path.join(name, "inputs.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps(inputs, sort_keys=True, indent=1))
+
+    # Build context
+    if artifacts:
+        adir = os.path.join(name, "artifacts")
+        if os.path.exists(adir):
+            shutil.rmtree(adir)
+        os.makedirs(adir)
+        for path in artifacts.values():
+            dst = os.path.join(adir, os.path.basename(path))
+            try:
+                os.link(path, dst)
+            except OSError:
+                shutil.copyfile(path, dst)
+
+    if verbose:
+        logger.info("You can now run: docker build -t %s %s", name, name)
+
+    return name
+
+
+def generate_data(version="3.1.1", artifacts=None, name=None,
+                  verbose=True,
+                  ):
+    """
+    Generate the Dockerfile of a data image, holding the datasets of an
+    SCT version once for all the images generated with `shared_data`.
+
+    The datasets are in a volume at `shared_data_path`, to be mounted
+    in the SCT containers (eg. with `docker run --volumes-from`).
+    The artifacts are bind mounted, so that they don't stay in a layer
+    of the image: it needs BuildKit.
+
+    :param version: SCT version
+    :param artifacts: dict of dataset name to path (see sct_docker_artifacts)
+    :returns: name
+    """
+
+    artifacts = dict((k, v) for k, v in (artifacts or dict()).items() if k in datasets)
+    missing = [x for x in datasets if x not in artifacts]
+    if missing:
+        raise ValueError("Missing dataset artifacts for {}: {}".format(version, ", ".join(missing)))
+
+    # What the image depends on, besides the Dockerfile (see sct_docker_build)
+    inputs = dict(distro="busybox", version=version, artifacts=artifacts)
+
+    frag = dockerfile_syntax + "\n" + """
+    FROM busybox
+    ENV SCT_DATA={path}
+    RUN mkdir -p {path} && chown 1000:1000 {path}
+    """.strip().format(path=shared_data_path)
+
+    for dataset in datasets:
+        # Extracted as sct_download_data does, owned by the sct user of the images
+        filename = os.path.basename(artifacts[dataset])
+        frag += "\n" + """
+        RUN --mount=type=bind,source=artifacts,target=/tmp/artifacts cd $(mktemp -d) && unzip -q /tmp/artifacts/{filename} && set -- * && if [ $# = 1 ] && [ -d "$1" ]; then mv "$1" {path}/{dataset}; else mkdir {path}/{dataset} && mv * {path}/{dataset}/; fi && chown -R 1000:1000 {path}/{dataset} && rm -rf $PWD
+        """.strip().format(path=shared_data_path, dataset=dataset, filename=filename)
+
+    frag += "\n" + """
+    VOLUME {}
+    """.strip().format(shared_data_path)
+
+    docker = "".join(x.lstrip() + "\n" for x in frag.split("\n"))
+
+    if name is None:
+        name = "sct-{}-data".format(version)
+
+    if not os.path.exists(name):
+        os.makedirs(name)
+    with io.open(os.path.join(name, "Dockerfile"), "wb") as f:
+        f.write(docker.encode("utf-8"))
+    with io.open(os.path.join(name, "inputs.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps(inputs, sort_keys=True, indent=1))
+
+    # Build context
+    adir = os.path.join(name, "artifacts")
+    if os.path.exists(adir):
+        shutil.rmtree(adir)
+    os.makedirs(adir)
+    for path in artifacts.values():
+        dst = os.path.join(adir, os.path.basename(path))
+        try:
+            os.link(path, dst)
+        except OSError:
+            shutil.copyfile(path, dst)
 
     if verbose:
         logger.info("You can now run: docker build -t %s %s", name, name)
@@ -576,6 +1162,39 @@ if __name__ == "__main__":
                       required=True,
                       )
 
+    subp.add_argument("--compact",
+                      action="store_true",
+                      help="Group package installations into one transaction per phase",
+                      default=False,
+                      )
+
+    subp.add_argument("--precompile",
+                      action="store_true",
+                      help="Precompile the Python modules and warm the first-run caches",
+                      default=False,
+                      )
+
+    subp.add_argument("--shared-data",
+                      action="store_true",
+                      help="Link the datasets to {}, to mount from a data image".format(shared_data_path),
+                      default=False,
+                      )
+
+    subp.add_argument("--cache-mounts",
+                      action="store_true",
+                      help="Keep package downloads in BuildKit cache mounts",
+                      default=False,
+                      )
+
+    subp.add_argument("--mirror",
+                      action="append",
+                      type=parse_mirror,
+                      metavar="KIND=URL[,CA_FILE]",
+                      help="Proxy/mirror to use during the build; KIND in: {}".format(
+                          ", ".join("{} ({})".format(k, v) for k, v in mirror_kinds.items())),
+                      default=[],
+                      )
+
     try:
         import argcomplete
 
@@ -586,7 +1205,9 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     if args.command == "generate":
-        name = generate(distro=args.distro, version=args.version)
+        name = generate(distro=args.distro, version=args.version, compact=args.compact,
+                        cache_mounts=args.cache_mounts, mirrors=dict(args.mirror),
+                        precompile=args.precompile, shared_data=args.shared_data)
         print(name)
     else:
         parser.print_help(sys.stderr)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 vi:noet
+# Host-side store of the artifacts downloaded when building images
+
+import sys, io, os, re, json, logging, shutil, hashlib, tarfile, time, subprocess
+import threading
+import multiprocessing.pool
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+
+sct_repository = "https://github.com/neuropoly/spinalcordtoolbox"
+sct_url = sct_repository + "/archive/{}.tar.gz"
+
+datasets = (
+ "sct_example_data",
+ "sct_testing_data",
+)
+
+# Serialize manifest updates of a version
+_lock = threading.Lock()
+
+
+def is_release(version):
+	"""
+	:return: whether a version is a release (immutable), rather than a branch
+	"""
+	return re.match(r"^v?\d+\.\d+\.\d+(-beta\.\d+)?$", version) is not None
+
+
+# Resolved branches, reused for `revision_ttl` seconds
+_revisions = dict()
+revision_ttl = 60
+
+
+def revision(version):
+	"""
+	:return: commit a version of SCT (branch, tag or commit) is at, or
+	 None if it can't be resolved (eg. offline)
+	"""
+	if re.match(r"^[0-9a-f]{40}$", version):
+		return version
+	with _lock:
+		cached = _revisions.get(version)
+	if cached is not None and time.time() - cached[0] < revision_ttl:
+		return cached[1]
+	cmd = ["git", "ls-remote", sct_repository, version, version + "^{}"]
+	try:
+		out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=60).decode()
+	except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+		logger.warning("Couldn't resolve SCT %s: %s", version, e)
+		return None
+	refs = dict(reversed(line.split("\t")) for line in out.splitlines() if "\t" in line)
+	for ref in ("refs/heads/{}", "refs/tags/{}^{{}}", "refs/tags/{}"):
+		commit = refs.get(ref.format(version))
+		if commit is not None:
+			with _lock:
+				_revisions[version] = (time.time(), commit)
+			return commit
+	logger.warning("SCT %s doesn't exist", version)
+
+
+def sha256sum(path):
+	h = hashlib.sha256()
+	with io.open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1 << 20), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def _load_manifest(store, version):
+	path = os.path.join(store, version, "manifest.json")
+	if not os.path.exists(path):
+		return dict()
+	with io.open(path, "r", encoding="utf-8") as f:
+		return json.load(f)
+
+
+def _save_manifest(store, version, manifest):
+	path = os.path.join(store, version, "manifest.json")
+	with io.open(path + ".part", "w", encoding="utf-8") as f:
+		f.write(json.dumps(manifest, sort_keys=True, indent=1))
+	os.rename(path + ".part", path)
+
+
+def _link(src, dst):
+	try:
+		os.link(src, dst)
+	except OSError:
+		shutil.copyfile(src, dst)
+
+
+def _verified(store, version, entry):
+	"""
+	:return: path of a stored artifact, if it still matches its checksum
+	"""
+	path = os.path.join(store, version, entry["file"])
+	if os.path.exists(path) and sha256sum(path) == entry["sha256"]:
+		return path
+	logger.warning("%s is missing or corrupted", path)
+
+
+def _download(urls, path):
+	"""
+	Download the first working URL to path, atomically
+	"""
+	for url in urls:
+		logger.info("Downloading %s", url)
+		try:
+			with urllib.request.urlopen(url) as r, io.open(path + ".part", "wb") as f:
+				shutil.copyfileobj(r, f, 1 << 20)
+		except (IOError, ValueError) as e:
+			logger.warning("Couldn't download %s: %s", url, e)
+			continue
+		os.rename(path + ".part", path)
+		return url
+	raise RuntimeError("Couldn't download any of {}".format(urls))
+
+
+def fetch(store, version, kind, urls, filename):
+	"""
+	Fetch an artifact into the store, unless it's already there.
+
+	Artifacts are stored as `<store>/<version>/<sha256 prefix>-<filename>`,
+	so that the name changes with the contents.
+	Artifacts of branches are fetched again every time.
+
+	:param kind: artifact name ("sct" or a dataset name)
+	:param urls: list of alternative URLs
+	:return: path of the stored artifact
+	"""
+	vdir = os.path.join(store, version)
+	with _lock:
+		if not os.path.exists(vdir):
+			os.makedirs(vdir)
+
+	entry = _load_manifest(store, version).get(kind)
+	if entry is not None and entry["url"] in urls and is_release(version):
+		path = _verified(store, version, entry)
+		if path is not None:
+			return path
+
+	tmp = os.path.join(vdir, "{}.{}".format(filename, threading.current_thread().ident))
+
+	# Reuse the same download done for another release
+	url = None
+	if is_release(version):
+		for other in sorted(os.listdir(store)):
+			if other == version or not is_release(other):
+				continue
+			entry = _load_manifest(store, other).get(kind)
+			if entry is not None and entry["url"] in urls:
+				path = _verified(store, other, entry)
+				if path is not None:
+					_link(path, tmp)
+					url = entry["url"]
+					break
+
+	if url is None:
+		url = _download(urls, tmp)
+
+	digest = sha256sum(tmp)
+	path = os.path.join(vdir, "{}-{}".format(digest[:16], filename))
+	os.rename(tmp, path)
+
+	with _lock:
+		manifest = _load_manifest(store, version)
+		old = manifest.get(kind)
+		manifest[kind] = dict(file=os.path.basename(path), url=url, sha256=digest)
+		_save_manifest(store, version, manifest)
+	if old is not None and old["file"] != manifest[kind]["file"]:
+		try:
+			os.unlink(os.path.join(vdir, old["file"]))
+		except OSError:
+			pass
+
+	return path
+
+
+def dataset_urls(sct_tarball, dataset):
+	"""
+	Find the URLs of a dataset, as `sct_download_data` would
+	:param sct_tarball: path to the SCT source tarball
+	:return: list of URLs (empty if not found)
+	"""
+	with tarfile.open(sct_tarball, "r:gz") as tar:
+		for member in tar:
+			if not member.name.endswith(("/sct_download_data.py", "/download.py")):
+				continue
+			code = tar.extractfile(member).read().decode("utf-8")
+			m = re.search(r"""['"]{}['"]\s*:\s*(\{{[^}}]*?['"]mirrors['"]\s*:\s*)?\[(?P<urls>[^\]]*)\]""".format(dataset), code)
+			if m is not None:
+				return re.findall(r"""['"](\w+://[^'"]+)['"]""", m.group("urls"))
+	return []
+
+
+def populate(store, versions, jobs=None):
+	"""
+	Fetch the SCT sources and datasets of versions, in parallel.
+
+	:return: dict of version to dict of artifact name to path
+	"""
+
+	pool = multiprocessing.pool.ThreadPool(jobs)
+
+	def fetch_version(version):
+		res = dict()
+		res["sct"] = fetch(store, version, "sct", [sct_url.format(version)],
+		 "spinalcordtoolbox-{}.tar.gz".format(version))
+
+		promises = list()
+		for dataset in datasets:
+			urls = dataset_urls(res["sct"], dataset)
+			if not urls:
+				logger.warning("Couldn't find the URLs of %s in SCT %s, it will be downloaded in the image", dataset, version)
+				continue
+			promises.append((dataset,
+			 pool.apply_async(fetch, (store, version, dataset, urls, "{}.zip".format(dataset)))))
+
+		for dataset, promise in promises:
+			res[dataset] = promise.get()
+		return res
+
+	# The versions don't use the pool, as they wait on it
+	threads = multiprocessing.pool.ThreadPool(len(versions))
+
+	try:
+		res = dict(zip(versions, threads.map(fetch_version, versions)))
+		threads.close()
+		pool.close()
+	finally:
+		threads.terminate()
+		pool.terminate()
+	threads.join()
+	pool.join()
+
+	return res
+
+
+def evict(store, keep):
+	"""
+	Remove the artifacts of versions other than the ones to keep
+	:param keep: versions to keep
+	:return: list of evicted versions
+	"""
+	evicted = list()
+	if not os.path.exists(store):
+		return evicted
+	for version in sorted(os.listdir(store)):
+		if version in keep or not os.path.isdir(os.path.join(store, version)):
+			continue
+		logger.info("Evicting %s", version)
+		shutil.rmtree(os.path.join(store, version))
+		evicted.append(version)
+	return evicted
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 vi:noet
+# Asyncio orchestration of generate/build/test/publish/export jobs
+
+import sys, io, os, json, logging, time, hashlib
+import asyncio, collections
+
+import sct_docker
+import sct_docker_trace
+from sct_docker_build import build_hash, find_up_to_date, image_id, build_command, \
+ build_failure, build_retry, load_costs, save_costs, cost_key, record_cost, log_filename
+
+logger = logging.getLogger(__name__)
+
+
+# Something that happened to a job:
+# - kind: "started", "step" (a build step started), "cached" (a build
+#   step was cached), "retrying" (a build is retried, see
+#   `sct_docker_build.build_image()`), "finished", "failed" or "cancelled"
+# - data: dict, eg. the instruction of a step, the result of a finished
+#   job, or the error of a failed one ("timeout" is set if it timed out)
+Event = collections.namedtuple("Event", ("time", "job", "kind", "data"))
+
+# Run a function of a module, in a child interpreter (see `Orchestrator.call()`)
+_child = """
+import sys, json, logging, importlib
+logging.basicConfig(level=logging.INFO)
+args, kwargs = json.loads(sys.argv[3])
+res = getattr(importlib.import_module(sys.argv[1]), sys.argv[2])(*args, **kwargs)
+sys.stdout.write(json.dumps(res))
+""".strip()
+
+# Time given to a process to exit when its job is cancelled, before it's killed
+terminate_delay = 10
+
+
+class Orchestrator(object):
+	"""
+	Concurrent jobs run as asyncio subprocesses, rather than with a
+	thread each; their progress is streamed as `Event`s:
+
+	.. code:: python
+
+	   async def main():
+	       o = Orchestrator(jobs=4)
+	       name = "sct-4.2.1-ubuntu-18.04"
+	       generate = o.generate("ubuntu:18.04", "4.2.1", name=name)
+	       build = o.build(name, timeout=3600, after=[generate])
+	       o.test(name, "sct_check_dependencies", after=[build])
+	       async for event in o.events():
+	           print(event)
+
+	Each job method returns an `asyncio.Task` (resulting in the job's
+	result), which can be cancelled, and given to other jobs as their
+	dependencies (`after`); a job whose dependencies didn't finish fails.
+	"""
+	def __init__(self, jobs=None):
+		"""
+		:param jobs: concurrent jobs (default: number of CPUs)
+		"""
+		self.semaphore = asyncio.Semaphore(jobs or os.cpu_count() or 1)
+		self.queue = asyncio.Queue()
+		self.tasks = collections.OrderedDict()
+		self.running = 0
+		self.costs = None
+
+	def emit(self, job, kind, **data):
+		self.queue.put_nowait(Event(time.time(), job, kind, data))
+
+	async def events(self):
+		"""
+		Events of the jobs, until they're all done
+		"""
+		while self.running or not self.queue.empty():
+			yield await self.queue.get()
+
+	async def wait(self):
+		"""
+		:return: dict of job to its result, or the exception it failed with
+		"""
+		tasks = list(self.tasks.values())
+		res = await asyncio.gather(*tasks, return_exceptions=True)
+		return collections.OrderedDict(zip(self.tasks, res))
+
+	def cancel(self, job=None):
+		"""
+		Cancel a job (its process is terminated), or all of them
+		"""
+		for name, task in self.tasks.items():
+			if job is None or name == job:
+				task.cancel()
+
+	def submit(self, job, f, timeout=None, after=()):
+		"""
+		Run a job
+		:param job: unique name of the job
+		:param f: coroutine function called with the job name
+		:param timeout: seconds after which the job is cancelled and fails
+		:param after: tasks of the jobs to wait for
+		:return: `asyncio.Task`
+		"""
+		if job in self.tasks:
+			raise ValueError("There's already a job named {}".format(job))
+		self.running += 1
+		task = asyncio.ensure_future(self._run(job, f, timeout, list(after)))
+		# Rather than in `_run()`, which doesn't run at all if the task
+		# is cancelled before it started
+		task.add_done_callback(lambda task: self._done(job, task, timeout))
+		self.tasks[job] = task
+		return task
+
+	async def _run(self, job, f, timeout, after):
+		names = dict((task, name) for name, task in self.tasks.items())
+		if after:
+			await asyncio.wait(after)
+			failed = [names.get(x, x) for x in after if x.cancelled() or x.exception() is not None]
+			if failed:
+				raise RuntimeError("Dependencies didn't finish: {}".format(failed))
+		async with self.semaphore:
+			self.emit(job, "started")
+			return await asyncio.wait_for(f(job), timeout)
+
+	def _done(self, job, task, timeout):
+		self.running -= 1
+		if task.cancelled():
+			self.emit(job, "cancelled")
+		elif isinstance(task.exception(), asyncio.TimeoutError):
+			self.emit(job, "failed", error="timed out after {}s".format(timeout), timeout=True)
+		elif task.exception() is not None:
+			self.emit(job, "failed", error=str(task.exception()))
+		else:
+			self.emit(job, "finished", result=task.result())
+
+	async def run_process(self, job, cmd, env=None, log=None, observers=()):
+		"""
+		Run a process, terminating it if the job is cancelled
+		:param log: binary file where to write the output
+		:param observers: objects whose `feed()` gets each output line
+		:return: error code, and the last lines of output
+		"""
+		tail = collections.deque(maxlen=100)
+		proc = await asyncio.create_subprocess_exec(*cmd, env=env,
+		 stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+		 limit=1 << 20)
+		try:
+			while True:
+				line = await proc.stdout.readline()
+				if not line:
+					break
+				if log is not None:
+					log.write(line)
+					log.flush()
+				line = line.decode("utf-8", "replace")
+				tail.append(line)
+				for observer in observers:
+					observer.feed(line)
+			return await proc.wait(), list(tail)
+		except asyncio.CancelledError:
+			await _terminate(proc)
+			raise
+
+	async def call(self, job, module, function, *args, **kwargs):
+		"""
+		Call a function of this package in a child interpreter, for those
+		doing their own stream processing (exports, pushes) to be killable.
+		Its log goes to `<job>.log`.
+
+		:return: result of the function (JSON-serializable)
+		"""
+		here = os.path.dirname(os.path.abspath(__file__))
+		env = dict(os.environ,
+		 PYTHONPATH=os.pathsep.join([here] + [x for x in [os.environ.get("PYTHONPATH")] if x]))
+		cmd = [sys.executable, "-c", _child, module, function, json.dumps([args, kwargs])]
+		path = "{}.log".format(job.replace("/", "-").replace(" ", "-"))
+		with io.open(path, "wb") as log:
+			proc = await asyncio.create_subprocess_exec(*cmd, env=env,
+			 stdout=asyncio.subprocess.PIPE, stderr=log)
+			try:
+				out, _ = await proc.communicate()
+			except asyncio.CancelledError:
+				await _terminate(proc)
+				raise
+		if proc.returncode != 0:
+			raise RuntimeError("{}.{} returned {} (see {})".format(module, function, proc.returncode, path))
+		return json.loads(out.decode("utf-8"))
+
+	def generate(self, distro, version, name=None, timeout=None, after=(), **options):
+		"""
+		Generate the Dockerfile of an image (see `sct_docker.generate()`)
+		:return: task resulting in the name of the image
+		"""
+		if name is None:
+			name = "sct-{}-{}".format(version, distro.replace(":", "-")).lower()
+
+		async def run(job):
+			return sct_docker.generate(distro=distro, version=version, name=name,
+			 verbose=False, **options)
+
+		return self.submit("generate {}".format(name), run, timeout=timeout, after=after)
+
+	def build(self, name, build_options=[], force=False, retries=3, timeout=None, after=()):
+		"""
+		Build an image (unless an image built from the same inputs exists),
+		its output going to `<name>/build.log`; failed builds are retried
+		and their costs remembered as with `sct_docker_build.build_image()`
+		:return: task resulting in a dict with name, status ("built" or
+		 "up to date") and duration
+		"""
+		async def run(job):
+			loop = asyncio.get_event_loop()
+			digest = await loop.run_in_executor(None, build_hash, name, build_options)
+
+			existing = await loop.run_in_executor(None, find_up_to_date, name, digest, build_options, force)
+			if existing is not None:
+				if await loop.run_in_executor(None, image_id, name) != existing:
+					err, tail = await self.run_process(job, ["docker", "tag", existing, name])
+					if err != 0:
+						raise RuntimeError("Couldn't tag {} as {}: {}".format(existing, name, err))
+				return dict(name=name, status="up to date", duration=0)
+
+			if self.costs is None:
+				self.costs = load_costs()
+			jobs = self.costs.get(cost_key(name), dict()).get("jobs")
+			attempt = 0
+			with io.open(os.path.join(name, log_filename), "wb") as log:
+				while True:
+					cmd, env = await loop.run_in_executor(None, build_command, name, digest, build_options, jobs)
+					trace = sct_docker_trace.BuildTrace(name)
+					steps = _StepEvents(self, job, trace)
+					err, tail = await self.run_process(job, cmd, env=env, log=log, observers=(trace, steps))
+					trace.finish()
+					trace.save()
+					if err == 0:
+						break
+					retry = build_retry(build_failure(tail), jobs, attempt, retries)
+					if retry is None:
+						break
+					jobs, attempt, delay, message = retry
+					log.write("--- {}\n".format(message).encode())
+					self.emit(job, "retrying", message=message)
+					await asyncio.sleep(delay)
+
+			duration = trace.end - trace.start
+			record_cost(self.costs, name, jobs, duration if err == 0 else None)
+			save_costs(self.costs)
+			if err != 0:
+				raise RuntimeError("docker build returned {} (see {})".format(err,
+				 os.path.join(name, log_filename)))
+			return dict(name=name, status="built", duration=duration)
+
+		return self.submit("build {}".format(name), run, timeout=timeout, after=after)
+
+	def test(self, name, command, shard=0, shards=1, log=None, timeout=None, after=()):
+		"""
+		Run a test command in a container of an image, as
+		`sct_docker_testing.run_command()` does
+		:param log: where to write the output
+		 (default: `<name>/test-logs/<hash of the command>-<shard>.log`)
+		:return: task resulting in a dict with name, command, shard, log
+		"""
+		if log is None:
+			log = os.path.join(name, "test-logs", "{}-{}.log".format(
+			 hashlib.sha1(command.encode("utf-8")).hexdigest()[:8], shard))
+
+		async def run(job):
+			if not os.path.exists(os.path.dirname(log)):
+				os.makedirs(os.path.dirname(log))
+			cmd = [
+			 "docker", "run", "--rm",
+			 "--env", "SCT_SHARD={}".format(shard),
+			 "--env", "SCT_SHARDS={}".format(shards),
+			 "--entrypoint", "/bin/bash",
+			 name, "-i", "-c", command,
+			]
+			with io.open(log, "wb") as f:
+				err, tail = await self.run_process(job, cmd, log=f)
+			if err != 0:
+				raise RuntimeError("{} failed with error code {} (see {})".format(command, err, log))
+			return dict(name=name, command=command, shard=shard, log=log)
+
+		return self.submit("test {} {}/{} {}".format(name, shard, shards, command), run,
+		 timeout=timeout, after=after)
+
+	def publish(self, name, repository, insecure=False, timeout=None, after=()):
+		"""
+		Push an image (see `sct_docker_publish.publish()`)
+		:return: task resulting in the dict returned by it
+		"""
+		async def run(job):
+			return await self.call(job, "sct_docker_publish", "publish", name, repository, insecure=insecure)
+
+		return self.submit("publish {}".format(name), run, timeout=timeout, after=after)
+
+	def export(self, name, source, timeout=None, after=(), **options):
+		"""
+		Generate a tarball of an image (see `sct_docker_export.export()`)
+		:return: task resulting in the dict returned by it
+		"""
+		async def run(job):
+			return await self.call(job, "sct_docker_export", "export", name, source, **options)
+
+		return self.submit("export {} {}".format(name, source), run, timeout=timeout, after=after)
+
+
+class _StepEvents(object):
+	"""
+	Emit the steps of a build, as they're found by its `BuildTrace`
+	(fed before this)
+	"""
+	def __init__(self, orchestrator, job, trace):
+		self.orchestrator = orchestrator
+		self.job = job
+		self.trace = trace
+		self.started = 0
+		self.cached = set()
+
+	def feed(self, line):
+		steps = self.trace.steps
+		for step in steps[self.started:]:
+			self.orchestrator.emit(self.job, "step", instruction=step["instruction"])
+		self.started = len(steps)
+		for idx, step in enumerate(steps):
+			if step["cached"] and idx not in self.cached:
+				self.cached.add(idx)
+				self.orchestrator.emit(self.job, "cached", instruction=step["instruction"])
+
+
+async def _terminate(proc):
+	if proc.returncode is not None:
+		return
+	proc.terminate()
+	try:
+		await asyncio.wait_for(proc.wait(), terminate_delay)
+	except asyncio.TimeoutError:
+		proc.kill()
+		await proc.wait()
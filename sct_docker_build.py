@@ -0,0 +1,727 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 vi:noet
+# Building of generated images
+
+import sys, io, os, re, json, logging, time, subprocess, hashlib
+import collections, threading
+
+import sct_docker_trace
+import sct_docker_progress
+import sct_docker_artifacts
+
+logger = logging.getLogger(__name__)
+
+
+# Label holding the hash of everything an image was built from
+label_hash = "org.neuropoly.sct-docker.build-hash"
+
+
+def image_id(name):
+	"""
+	:return: ID of a local image, or None if it doesn't exist
+	"""
+	cmd = ["docker", "image", "inspect", "--format", "{{.Id}}", name]
+	try:
+		return subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode().strip()
+	except subprocess.CalledProcessError:
+		return None
+
+
+_base_digests = dict()
+_base_digests_lock = threading.Lock()
+
+
+def base_digest(name):
+	"""
+	Identify a base image: a registry image is pulled first, so that a
+	tag that moved upstream is noticed, and identified by its registry
+	digest; an image built locally (eg. `sct-base-*`) by its ID.
+
+	:return: digest or ID, or None if the image can't be found
+	"""
+	with _base_digests_lock:
+		if name in _base_digests:
+			return _base_digests[name]
+
+	cmd = ["docker", "image", "inspect", "--format", "{{.Id}} {{json .RepoDigests}}", name]
+	try:
+		local, digests = subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode().split(" ", 1)
+		if not json.loads(digests):
+			return local
+	except subprocess.CalledProcessError:
+		pass
+
+	err = subprocess.call(["docker", "pull", "--quiet", name],
+	 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	if err != 0:
+		logger.warning("Couldn't pull %s (%d)", name, err)
+	cmd = ["docker", "image", "inspect", "--format", "{{json .RepoDigests}}", name]
+	try:
+		digests = json.loads(subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode())
+	except subprocess.CalledProcessError:
+		return None
+	if not digests:
+		return None
+	# The same manifest, whatever the repository it was pulled from
+	digest = sorted(x.split("@", 1)[1] for x in digests)[0]
+	if err == 0:
+		with _base_digests_lock:
+			_base_digests[name] = digest
+	return digest
+
+
+def image_size(name):
+	"""
+	:return: size in bytes of a local image, or None if it doesn't exist
+	"""
+	cmd = ["docker", "image", "inspect", "--format", "{{.Size}}", name]
+	try:
+		return int(subprocess.check_output(cmd, stderr=subprocess.DEVNULL))
+	except (subprocess.CalledProcessError, ValueError):
+		return None
+
+
+def buildkit_available():
+	"""
+	:return: whether the docker daemon supports BuildKit (18.09+)
+	"""
+	cmd = ["docker", "version", "--format", "{{.Server.Version}}"]
+	try:
+		version = subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode()
+	except (subprocess.CalledProcessError, OSError):
+		return False
+	m = re.match(r"^(\d+)\.(\d+)", version.strip())
+	return m is not None and (int(m.group(1)), int(m.group(2))) >= (18, 9)
+
+
+def parse_size(spec):
+	"""
+	:param spec: size, with optional K/M/G/T suffix (eg. "8G")
+	:return: size in bytes
+	"""
+	m = re.match(r"^(?P<n>\d+(\.\d+)?)(?P<unit>[KMGT]?)i?B?$", spec.strip(), re.I)
+	if m is None:
+		raise ValueError("Invalid size: {}".format(spec))
+	return int(float(m.group("n")) * 1024 ** " KMGT".index(m.group("unit").upper() or " "))
+
+
+def available_memory():
+	"""
+	:return: physical memory in bytes, or None if unknown
+	"""
+	try:
+		return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+	except (ValueError, OSError, AttributeError):
+		return None
+
+
+def needs_buildkit(name):
+	"""
+	:return: whether the Dockerfile of an image uses BuildKit features
+	"""
+	with io.open(os.path.join(name, "Dockerfile"), "r", encoding="utf-8") as f:
+		return any(x.startswith("# syntax=") or " --mount=" in x for x in f)
+
+
+def dockerfile_bases(path):
+	"""
+	:return: list of images referenced by FROM instructions of a Dockerfile
+	"""
+	if os.path.isdir(path):
+		path = os.path.join(path, "Dockerfile")
+	stages = set()
+	bases = list()
+	with io.open(path, "r", encoding="utf-8") as f:
+		for line in f:
+			m = re.match(r"^FROM\s+(?P<image>\S+)(\s+AS\s+(?P<stage>\S+))?", line, re.I)
+			if m is None:
+				continue
+			if m.group("image") not in stages:
+				bases.append(m.group("image"))
+			if m.group("stage"):
+				stages.add(m.group("stage"))
+	return bases
+
+
+def _inputs(name):
+	path = os.path.join(name, "inputs.json")
+	if not os.path.exists(path):
+		return dict()
+	with io.open(path, "r", encoding="utf-8") as f:
+		return json.load(f)
+
+
+def sct_revision(name):
+	"""
+	:return: commit of the SCT branch an image installs (given to its
+	 build as `SCT_REVISION`, see `sct_docker.generate()`), None if it
+	 can't be resolved, or "" if the Dockerfile identifies the sources
+	 (release, or artifact)
+	"""
+	inputs = _inputs(name)
+	version = inputs.get("version")
+	if version is None or sct_docker_artifacts.is_release(version) \
+	 or "sct" in (inputs.get("artifacts") or dict()):
+		return ""
+	return sct_docker_artifacts.revision(version)
+
+
+def proxy_args(name):
+	"""
+	:return: build options giving the proxy of an image (see
+	 `sct_docker.generate()` mirrors) to its build, as the predefined proxy
+	 arguments, which aren't kept in the image history
+	"""
+	proxy = (_inputs(name).get("mirrors") or dict()).get("proxy")
+	if proxy is None:
+		return []
+	url = proxy if isinstance(proxy, str) else proxy[0]
+	res = []
+	for variable in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
+		res += ["--build-arg", "{}={}".format(variable, url)]
+	return res
+
+
+def revision_args(name):
+	"""
+	:return: build options giving the SCT commit to an image installing a
+	 branch, so that the layer installing it isn't reused when the branch
+	 moves (nor when it can't be resolved)
+	"""
+	revision = sct_revision(name)
+	if revision == "":
+		return []
+	return ["--build-arg", "SCT_REVISION={}".format(revision or "unknown-{}".format(int(time.time())))]
+
+
+def build_hash(name, build_options=[]):
+	"""
+	Compute the hash of what an image is built from: its Dockerfile, the
+	`sct_docker.generate()` inputs, the build options, the base images
+	(see `base_digest()`), the SCT sources (commit of a branch) and the
+	checksums of the artifacts.
+
+	:param name: image name (directory containing a Dockerfile)
+	:return: hash, or None if the SCT branch or a base image can't be
+	 resolved
+	"""
+	revision = sct_revision(name)
+	if revision is None:
+		return None
+
+	h = hashlib.sha256()
+	h.update(revision.encode("utf-8"))
+	h.update(b"\0")
+
+	for kind, path in sorted((_inputs(name).get("artifacts") or dict()).items()):
+		if os.path.exists(path):
+			h.update("{}={}".format(kind, sct_docker_artifacts.sha256sum(path)).encode("utf-8"))
+			h.update(b"\0")
+
+	for filename in ("Dockerfile", "inputs.json"):
+		path = os.path.join(name, filename)
+		if os.path.exists(path):
+			with io.open(path, "rb") as f:
+				h.update(f.read())
+		h.update(b"\0")
+
+	for base in dockerfile_bases(name):
+		digest = base_digest(base)
+		if digest is None:
+			return None
+		h.update(digest.encode("utf-8"))
+		h.update(b"\0")
+
+	h.update(json.dumps([x for x in build_options if x != "--no-cache"]).encode("utf-8"))
+
+	return h.hexdigest()
+
+
+def find_built(digest):
+	"""
+	:return: ID of a local image labelled with this build hash, or None
+	"""
+	cmd = ["docker", "images", "--quiet", "--no-trunc",
+	 "--filter", "label={}={}".format(label_hash, digest)]
+	try:
+		ids = subprocess.check_output(cmd).decode().split()
+	except subprocess.CalledProcessError:
+		return None
+	if ids:
+		return ids[0]
+
+
+# Build output, in the image directory (when not shown on stdout)
+log_filename = "build.log"
+
+# Where the costs of previous builds are remembered
+costs_path = os.path.join(os.path.expanduser("~"), ".cache", "sct-docker", "build-costs.json")
+
+_costs_lock = threading.Lock()
+
+# Build output telling that a step failed because of a (probably)
+# transient network error, from curl, apt, dnf/yum, pip or git
+_network_re = re.compile(r"curl: \((6|7|18|28|35|52|56)\)|Curl error \((6|7|18|28|35|52|56)\)"
+ r"|Temporary failure resolving|Could not resolve host|Could not connect to|Connection timed out"
+ r"|Failed to fetch|Hash Sum mismatch|Unable to fetch some archives"
+ r"|Cannot download repomd\.xml|Failed to download metadata for repo|Cannot retrieve metalink"
+ r"|No more mirrors to try|Errors during downloading metadata"
+ r"|ReadTimeoutError|NewConnectionError|Max retries exceeded|Connection reset by peer"
+ r"|Could not fetch URL|ProtocolError|HTTP error 5\d\d|RPC failed|early EOF", re.I)
+
+# Delay before retrying after a network error, doubled at each retry
+network_retry_delay = 30
+
+# Build output telling that a step was killed for lack of memory
+_oom_re = re.compile(r"returned a non-zero code: 137|exit code: 137|Killed signal terminated program"
+ r"|virtual memory exhausted|Cannot allocate memory|MemoryError|out of memory", re.I)
+
+
+def load_costs(path=costs_path):
+	"""
+	:return: dict of cost key to dict of duration (s), memory (bytes),
+	 cpus and jobs (parallelism that didn't run out of memory)
+	"""
+	if not os.path.exists(path):
+		return dict()
+	with io.open(path, "r", encoding="utf-8") as f:
+		return json.load(f)
+
+
+def save_costs(costs, path=costs_path):
+	with _costs_lock:
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with io.open(path + ".part", "w", encoding="utf-8") as f:
+			f.write(json.dumps(costs, sort_keys=True, indent=1))
+		os.rename(path + ".part", path)
+
+
+def cost_key(name):
+	"""
+	:return: key under which the cost of building an image is remembered;
+	 images differing only by SCT version share it
+	"""
+	path = os.path.join(name, "inputs.json")
+	if not os.path.exists(path):
+		return name
+	with io.open(path, "r", encoding="utf-8") as f:
+		inputs = json.load(f)
+	key = inputs["distro"]
+	for k, v in sorted(inputs.items()):
+		if v is True:
+			key += "+{}".format(k)
+	if any(x.startswith("sct-base-") for x in dockerfile_bases(name)):
+		key += "+base"
+	return key
+
+
+def estimate_cost(name, costs):
+	"""
+	:return: expected cost of building an image (see `load_costs()`);
+	 without history, images compiling wxPython are assumed to need all
+	 the CPUs and a lot of memory
+	"""
+	with io.open(os.path.join(name, "Dockerfile"), "r", encoding="utf-8") as f:
+		compiles = "wxPython" in f.read()
+
+	if compiles:
+		cost = dict(duration=3600, memory=4 << 30, cpus=os.cpu_count() or 1)
+	else:
+		cost = dict(duration=600, memory=1 << 30, cpus=1)
+
+	cost.update(costs.get(cost_key(name), dict()))
+	return cost
+
+
+class BuildMonitor(object):
+	"""
+	Sample the memory and CPU usage of the build containers of an image,
+	as found in the build output (BuildKit steps can't be observed).
+	"""
+	def __init__(self, interval=5):
+		self.interval = interval
+		self.container = None
+		self.memory = None
+		self.cpus = None
+		self.done = threading.Event()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def feed(self, line):
+		m = re.match(r"^ ---> Running in (?P<id>[0-9a-f]+)", line)
+		if m is not None:
+			self.container = m.group("id")
+
+	def run(self):
+		while not self.done.wait(self.interval):
+			if self.container is None:
+				continue
+			cmd = ["docker", "stats", "--no-stream", "--format", "{{.MemUsage}}\t{{.CPUPerc}}", self.container]
+			try:
+				out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode()
+				mem, cpu = out.strip().split("\t")
+				mem = parse_size(mem.split("/")[0])
+				cpu = float(cpu.rstrip("%")) / 100
+			except (subprocess.CalledProcessError, ValueError):
+				continue
+			self.memory = max(self.memory or 0, mem)
+			self.cpus = max(self.cpus or 0, cpu)
+
+	def stop(self):
+		self.done.set()
+		self.thread.join()
+
+
+def run_build(cmd, env=None, observers=(), log=None, cancel=None):
+	"""
+	Run a build, writing its output to a log file (or stdout)
+	:param observers: objects whose `feed()` gets each output line
+	:param log: binary file where to write the output
+	:param cancel: `threading.Event` upon which the build is terminated
+	:return: error code, and the last lines of output
+	"""
+	tail = collections.deque(maxlen=100)
+	proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+	def watch():
+		while proc.poll() is None:
+			if cancel.wait(1):
+				proc.terminate()
+				break
+
+	if cancel is not None:
+		watcher = threading.Thread(target=watch)
+		watcher.daemon = True
+		watcher.start()
+
+	for line in iter(proc.stdout.readline, b""):
+		if log is None:
+			sys.stdout.buffer.write(line)
+			sys.stdout.flush()
+		else:
+			log.write(line)
+			log.flush()
+		line = line.decode("utf-8", "replace")
+		tail.append(line)
+		for observer in observers:
+			observer.feed(line)
+	return proc.wait(), list(tail)
+
+
+def find_up_to_date(name, digest, build_options=[], force=False):
+	"""
+	:param digest: build hash of the image (see `build_hash()`), or None
+	:param force: build even if up to date
+	:return: ID of an image built from the same inputs, or None if the
+	 image is to be built
+	"""
+	if digest is None or force or "--no-cache" in build_options:
+		return None
+	return find_built(digest)
+
+
+def build_command(name, digest, build_options=[], jobs=None):
+	"""
+	:param digest: build hash to label the image with, or None
+	:param jobs: parallelism of the build (MAKEFLAGS, and the CPUs given to
+	 the build containers without BuildKit), default: unlimited
+	:return: `docker build` command, and its environment (None to inherit it)
+	"""
+	env = None
+	# Not part of the build hash, the result is the same
+	limits = []
+	buildkit = needs_buildkit(name)
+	if buildkit:
+		env = dict(os.environ, DOCKER_BUILDKIT="1")
+		limits += ["--progress=plain"]
+	if jobs is not None:
+		limits += ["--build-arg", "MAKEFLAGS=-j{}".format(jobs)]
+		if not buildkit:
+			limits += ["--cpuset-cpus", "0-{}".format(jobs - 1)]
+
+	cmd = [
+	 "docker", "build",
+	 "-t", name, name,
+	] + build_options + proxy_args(name) + revision_args(name) + limits
+	if digest is not None:
+		cmd += ["--label", "{}={}".format(label_hash, digest)]
+	return cmd, env
+
+
+def build_failure(tail):
+	"""
+	:param tail: last lines of output of a failed build
+	:return: "oom" if a step was killed for lack of memory, "network" if
+	 it failed on what looks like a transient network error, or None
+	"""
+	if any(_oom_re.search(x) for x in tail):
+		return "oom"
+	if any(_network_re.search(x) for x in tail):
+		return "network"
+
+
+def build_retry(failure, jobs, attempt, retries):
+	"""
+	:param failure: kind of failure of the build (see `build_failure()`)
+	:param jobs: its parallelism
+	:param attempt: number of retries after network errors so far
+	:return: parallelism and number of network retries of the retry, delay
+	 before it (s) and message, or None if the build isn't to be retried
+	"""
+	if failure == "oom" and jobs != 1:
+		jobs = max(1, (jobs or os.cpu_count() or 2) // 2)
+		return jobs, attempt, 0, "Ran out of memory, retrying with {} jobs".format(jobs)
+	if failure == "network" and attempt < retries:
+		delay = network_retry_delay * 2 ** attempt
+		return jobs, attempt + 1, delay, "Network error, retrying in {}s ({}/{})".format(delay, attempt + 1, retries)
+
+
+def record_cost(costs, name, jobs=None, duration=None, memory=None, cpus=None):
+	"""
+	Remember the cost of a build in `costs` (see `load_costs()`)
+	:param jobs: parallelism that didn't run out of memory
+	:param duration: of the build, None if it failed
+	:param memory: peak memory (bytes) of the build, or when it ran out
+	"""
+	key = cost_key(name)
+	with _costs_lock:
+		cost = dict(costs.get(key, dict()))
+		if duration is not None:
+			cost["duration"] = duration
+			if memory is not None:
+				cost["memory"] = memory
+			if cpus is not None:
+				cost["cpus"] = max(1, int(cpus + 0.5))
+		elif memory is not None:
+			cost["memory"] = max(cost.get("memory", 0), memory)
+		if jobs is not None:
+			cost["jobs"] = jobs
+		costs[key] = cost
+
+
+def build_image(name, build_options=[], force=False, costs=None, progress=None,
+ retries=3, cancel=None, built=None):
+	"""
+	Build an image, unless an image built from the same inputs exists
+	(as it's the case when resuming an interrupted run).
+
+	When a step is killed for lack of memory, the build is retried with
+	half the parallelism (MAKEFLAGS, and the CPUs given to the build
+	containers), down to 1.
+	When it fails on what looks like a transient network error, it's
+	retried after a delay, doubled each time.
+
+	:param force: build even if up to date
+	:param costs: costs of previous builds, updated with this one
+	:param progress: `sct_docker_progress.ProgressView` showing the build;
+	 if given, the output goes to `<name>/build.log` instead of stdout
+	:param retries: number of retries after network errors
+	:param cancel: `threading.Event` upon which the build is terminated
+	:param built: set to which the image is added if it was actually
+	 built (rather than found up to date)
+	:return: error code
+	"""
+
+	digest = build_hash(name, build_options)
+	if digest is None:
+		logger.warning("%s: the SCT sources or base images can't be identified, building it", name)
+
+	existing = find_up_to_date(name, digest, build_options, force)
+	if existing is not None:
+		logger.info("%s is up to date (%s)", name, digest[:12])
+		err = 0
+		if image_id(name) != existing:
+			err = subprocess.call(["docker", "tag", existing, name])
+		if progress is not None:
+			progress.finish(name, "up to date" if err == 0 else "failed tagging ({})".format(err))
+		return err
+
+	if costs is None:
+		costs = dict()
+
+	path = os.path.join(name, sct_docker_trace.trace_filename)
+	if os.path.exists(path):
+		os.unlink(path)
+
+	log = None
+	if progress is not None:
+		log = io.open(os.path.join(name, log_filename), "wb")
+
+	try:
+		jobs = costs.get(cost_key(name), dict()).get("jobs")
+		attempt = 0
+		oom_memory = None
+		while True:
+			cmd, env = build_command(name, digest, build_options, jobs)
+
+			monitor = BuildMonitor()
+			trace = sct_docker_trace.BuildTrace(name)
+			if progress is not None:
+				progress.add(name, trace)
+			try:
+				err, tail = run_build(cmd, env=env, observers=(monitor, trace), log=log, cancel=cancel)
+			finally:
+				monitor.stop()
+			trace.finish()
+			trace.save()
+			duration = trace.end - trace.start
+
+			if err == 0 or (cancel is not None and cancel.is_set()):
+				break
+
+			failure = build_failure(tail)
+			if failure == "oom":
+				oom_memory = max(oom_memory or 0, monitor.memory or 0)
+
+			retry = build_retry(failure, jobs, attempt, retries)
+			if retry is None:
+				break
+			jobs, attempt, delay, message = retry
+
+			logger.warning("%s: %s", name, message)
+			if log is not None:
+				log.write("--- {}\n".format(message).encode())
+			if progress is not None:
+				progress.add(name, None, message)
+
+			if delay:
+				if cancel is None:
+					time.sleep(delay)
+				elif cancel.wait(delay):
+					break
+	finally:
+		if log is not None:
+			log.close()
+
+	if err == 0:
+		if built is not None:
+			built.add(name)
+		record_cost(costs, name, jobs, duration, monitor.memory or oom_memory, monitor.cpus)
+	else:
+		record_cost(costs, name, jobs, memory=oom_memory)
+
+	if progress is not None:
+		if err == 0:
+			progress.finish(name, "built")
+		elif cancel is not None and cancel.is_set():
+			progress.finish(name, "cancelled")
+		else:
+			progress.finish(name, "failed ({})".format(err),
+			 log=os.path.join(name, log_filename), tail=tail[-30:])
+
+	return err
+
+
+def build_images(names, jobs=None, build_options=[], force=False,
+ cpus=None, memory=None, progress=True, fail_fast=False, retries=3,
+ on_built=None, built=None):
+	"""
+	Build images in parallel, within CPU and memory budgets.
+
+	The expected cost of each build comes from the previous runs
+	(see `estimate_cost()`); the longest builds are started first, and
+	a build is started only if it fits in what's left of the budgets
+	(or if nothing else is running).
+
+	:param jobs: maximum number of concurrent builds (default: no limit)
+	:param cpus: CPU budget (default: number of CPUs)
+	:param memory: memory budget in bytes (default: physical memory)
+	:param progress: show the status of the builds, rather than their
+	 output (which goes to their `build.log`)
+	:param fail_fast: on the first failure, terminate the running builds
+	 and don't start the others
+	:param retries: number of retries of builds failing on network errors
+	:param on_built: function called with the name of each image as soon
+	 as it's successfully built (or found up to date)
+	:param built: set to which the images actually built (rather than
+	 found up to date) are added
+	:return: list of error codes (None for builds cancelled before starting)
+	"""
+
+	if cpus is None:
+		cpus = os.cpu_count() or 1
+
+	if memory is None:
+		memory = available_memory() or float("inf")
+
+	costs = load_costs()
+	estimates = dict((name, estimate_cost(name, costs)) for name in names)
+	pending = sorted(names, key=lambda x: -estimates[x]["duration"])
+
+	cond = threading.Condition()
+	running = set()
+	used = dict(cpus=0, memory=0)
+	res = dict()
+	cancel = threading.Event()
+
+	def need(name):
+		return min(cpus, estimates[name]["cpus"]), min(memory, estimates[name]["memory"])
+
+	def work(name):
+		err = -1
+		try:
+			err = build_image(name, build_options, force, costs, view,
+			 retries=retries, cancel=cancel, built=built)
+			if err != 0 and fail_fast and not cancel.is_set():
+				logger.error("%s failed, cancelling the other builds", name)
+				cancel.set()
+			if err == 0 and on_built is not None:
+				on_built(name)
+			save_costs(costs)
+		except Exception:
+			logger.exception("%s failed", name)
+		finally:
+			with cond:
+				c, m = need(name)
+				used["cpus"] -= c
+				used["memory"] -= m
+				running.remove(name)
+				res[name] = err
+				cond.notify_all()
+
+	view = None
+	if progress:
+		view = sct_docker_progress.ProgressView()
+		view.start()
+
+	try:
+		with cond:
+			while pending or running:
+				if cancel.is_set():
+					for name in pending:
+						res[name] = None
+						if view is not None:
+							view.finish(name, "cancelled")
+					del pending[:]
+				for name in list(pending):
+					if jobs is not None and len(running) >= jobs:
+						break
+					c, m = need(name)
+					if running and (used["cpus"] + c > cpus or used["memory"] + m > memory):
+						continue
+					logger.info("Building %s (expected %ds, %d CPUs, %.1fG)", name,
+					 estimates[name]["duration"], c, m / (1 << 30))
+					pending.remove(name)
+					running.add(name)
+					used["cpus"] += c
+					used["memory"] += m
+					thread = threading.Thread(target=work, args=(name,))
+					thread.daemon = True
+					thread.start()
+				cond.wait()
+	finally:
+		if view is not None:
+			view.stop()
+
+	errs = list()
+	for name in names:
+		err = res[name]
+		if err is None:
+			logger.error("{} was cancelled".format(name))
+		elif err != 0:
+			logger.error("{} failed with error code {}".format(name, err))
+		errs.append(err)
+
+	return errs
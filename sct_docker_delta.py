@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 vi:noet
+# Delta tarballs between the exports of two SCT versions
+
+import sys, io, os, re, json, logging, time, subprocess, tempfile, tarfile
+import copy
+import multiprocessing.pool
+
+from sct_docker_export import compressors, compressor_for, HashingReader, HashingWriter, \
+ file_sha256, read_sha256, read_manifest, write_manifest
+
+logger = logging.getLogger(__name__)
+
+
+# PAX header of the files of a delta that are to be taken from the base
+# tarball (their data is left out), value is the name in the base tarball
+base_key = "SCT.base"
+
+
+def _decompress(path):
+	comp = compressors[compressor_for(path)]
+	f = io.open(path, "rb")
+	try:
+		return subprocess.Popen([comp.exe, "-d", "-c"], stdin=f, stdout=subprocess.PIPE)
+	finally:
+		f.close()
+
+
+def _compress(compressor, f, threads=None):
+	comp = compressors[compressor]
+	return subprocess.Popen([comp.exe] + comp.args(threads or os.cpu_count() or 1),
+	 stdin=subprocess.PIPE, stdout=f)
+
+
+def _check(procs, what):
+	for proc in procs:
+		err = proc.wait()
+		if err != 0:
+			raise RuntimeError("{}: {} returned {}".format(what, proc.args[0], err))
+
+
+def delta_path(target, base_version):
+	"""
+	:return: default name of the delta of a tarball (`sct-<v>-<distro>-<source>.tar.<ext>`)
+	 against its previous version
+	"""
+	m = re.match(r"^(?P<stem>.*)\.tar(?P<ext>\.\w+)$", target)
+	return "{}-from-{}.tar{}".format(m.group("stem"), base_version, m.group("ext"))
+
+
+def make_delta(base, target, path, threads=None):
+	"""
+	Write the delta of a tarball (docker or offline, with its `.manifest`)
+	against a base one: the target tarball where the files that have the
+	same content in the base are replaced by a reference to them.
+
+	The delta gets a `<path>.json` file with the checksums of the base and
+	target tarballs, and a `.sha256` file.
+
+	:param threads: compressor threads
+	:return: description of the delta (contents of `<path>.json`)
+	"""
+	in_base = dict((digest, name) for digest, name in read_manifest(base))
+	in_target = dict((name, digest) for digest, name in read_manifest(target))
+	compressor = compressor_for(target)
+
+	t0 = time.time()
+	reused = 0
+
+	dec = _decompress(target)
+	reader = HashingReader(dec.stdout)
+	with io.open(path + ".part", "wb") as f:
+		cmp = _compress(compressor, f, threads)
+		try:
+			writer = HashingWriter(cmp.stdin)
+			with tarfile.open(fileobj=reader, mode="r|") as src, \
+			 tarfile.open(fileobj=writer, mode="w|") as dst:
+				for member in src:
+					base_name = in_base.get(in_target.get(member.name)) if member.isreg() else None
+					if base_name is None:
+						dst.addfile(member, src.extractfile(member) if member.isreg() else None)
+						continue
+					info = copy.copy(member)
+					info.pax_headers = dict(member.pax_headers)
+					info.pax_headers[base_key] = base_name
+					info.size = 0
+					dst.addfile(info)
+					reused += member.size
+			# the end-of-archive padding is part of the target
+			for chunk in iter(lambda: reader.read(1 << 20), b""):
+				pass
+		finally:
+			cmp.stdin.close()
+		_check([dec, cmp], "Making {}".format(path))
+
+	os.rename(path + ".part", path)
+
+	res = dict(
+	 base=os.path.basename(base),
+	 base_sha256=read_sha256(base),
+	 target=os.path.basename(target),
+	 sha256=read_sha256(target),
+	 tar_sha256=reader.h.hexdigest(),
+	 compressor=compressor,
+	 size=os.path.getsize(path),
+	 target_size=os.path.getsize(target),
+	 reused=reused,
+	 duration=time.time() - t0,
+	)
+
+	with io.open(path + ".json", "w", encoding="utf-8") as f:
+		f.write(json.dumps(res, indent=1))
+	with io.open(path + ".sha256", "w", encoding="utf-8") as f:
+		f.write("{}  {}\n".format(file_sha256(path), os.path.basename(path)))
+
+	logger.info("%s: %.1fM instead of %.1fM (%.1fM reused from %s) in %.1fs",
+	 path, res["size"] / 1e6, res["target_size"] / 1e6, reused / 1e6,
+	 res["base"], res["duration"])
+
+	return res
+
+
+def apply_delta(base, delta, path=None):
+	"""
+	Rebuild a tarball from its base and delta, and verify it (the
+	uncompressed tarball is the original one, byte for byte).
+	Its `.sha256` and `.manifest` files are written too.
+
+	:param path: where to write it (default: its original name, next to the delta)
+	:return: path
+	"""
+	with io.open(delta + ".json", "r", encoding="utf-8") as f:
+		info = json.load(f)
+
+	if path is None:
+		path = os.path.join(os.path.dirname(delta), info["target"])
+
+	if file_sha256(base) != info["base_sha256"]:
+		raise RuntimeError("{} is not the base of {} ({})".format(base, delta, info["base"]))
+
+	manifest = list()
+	with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp:
+		# random access to the base files
+		base_tar = os.path.join(tmp, "base.tar")
+		with io.open(base_tar, "wb") as f:
+			dec = _decompress(base)
+			for chunk in iter(lambda: dec.stdout.read(1 << 20), b""):
+				f.write(chunk)
+			_check([dec], "Decompressing {}".format(base))
+
+		dec = _decompress(delta)
+		with tarfile.open(base_tar, "r:") as old, io.open(path + ".part", "wb") as f:
+			cmp = _compress(info["compressor"], f)
+			try:
+				writer = HashingWriter(cmp.stdin)
+				with tarfile.open(fileobj=dec.stdout, mode="r|") as src, \
+				 tarfile.open(fileobj=writer, mode="w|") as dst:
+					for member in src:
+						base_name = member.pax_headers.pop(base_key, None)
+						if base_name is not None:
+							old_member = old.getmember(base_name)
+							member.size = old_member.size
+							data = old.extractfile(old_member)
+						elif member.isreg():
+							data = src.extractfile(member)
+						else:
+							dst.addfile(member)
+							continue
+						reader = HashingReader(data)
+						dst.addfile(member, reader)
+						manifest.append((reader.h.hexdigest(), member.name))
+			finally:
+				cmp.stdin.close()
+			_check([dec, cmp], "Applying {}".format(delta))
+
+	if writer.h.hexdigest() != info["tar_sha256"]:
+		os.unlink(path + ".part")
+		raise RuntimeError("{} rebuilt from {} doesn't match the original".format(path, delta))
+
+	os.rename(path + ".part", path)
+
+	digest = file_sha256(path)
+	with io.open(path + ".sha256", "w", encoding="utf-8") as f:
+		f.write("{}  {}\n".format(digest, os.path.basename(path)))
+	write_manifest(path, manifest)
+
+	if digest == info["sha256"]:
+		logger.info("%s rebuilt, identical to the original", path)
+	else:
+		# eg. another compressor version
+		logger.info("%s rebuilt, its contents match the original", path)
+
+	return path
+
+
+def make_deltas(pairs, jobs=None):
+	"""
+	Make deltas in parallel
+	:param pairs: list of (base, target, path)
+	:return: list of results of `make_delta()`
+	"""
+	if not pairs:
+		return []
+	cpus = os.cpu_count() or 1
+	jobs = min(len(pairs), jobs or cpus)
+	threads = max(1, cpus // jobs)
+	pool = multiprocessing.pool.ThreadPool(jobs)
+	try:
+		res = pool.starmap(make_delta, [x + (threads,) for x in pairs])
+		pool.close()
+	finally:
+		pool.terminate()
+	pool.join()
+	return res
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 vi:noet
+# Export of built images as compressed tarballs
+
+import sys, io, os, re, json, logging, time, subprocess, hashlib, tempfile, tarfile
+import collections, threading
+import multiprocessing.pool
+
+from sct_docker import printf, check_exe, datasets
+from sct_docker_build import available_memory
+
+logger = logging.getLogger(__name__)
+
+
+Compressor = collections.namedtuple("Compressor", (
+ "exe", # executable
+ "ext", # file extension
+ "args", # function of the thread count returning the arguments
+ "memory", # approximate memory used per thread, in bytes
+))
+
+compressors = collections.OrderedDict((
+ ("xz", Compressor("xz", ".xz",
+  lambda threads: ["--threads={}".format(threads), "--best"],
+  700 << 20)),
+ ("zstd", Compressor("zstd", ".zst",
+  lambda threads: ["-T{}".format(threads), "--ultra", "-20", "--long=27"],
+  600 << 20)),
+ ("pigz", Compressor("pigz", ".gz",
+  lambda threads: ["-p", str(threads), "-9"],
+  2 << 20)),
+ ("gzip", Compressor("gzip", ".gz",
+  lambda threads: ["-9"],
+  2 << 20)),
+))
+
+default_compressor = "xz"
+
+
+def compressor_for(path):
+	"""
+	:return: name of an available compressor for a tarball, from its extension
+	"""
+	for name, comp in compressors.items():
+		if path.endswith(".tar" + comp.ext) and check_exe(comp.exe):
+			return name
+	raise RuntimeError("No available compressor for {}".format(path))
+
+# Files of the SCT installation not needed in offline archives:
+# VCS data, bytecode (regenerated), conda package cache
+offline_excluded = re.compile(r"(^|/)(\.git|__pycache__)(/|$)|\.py[co]$|^[^/]+/python/pkgs(/|$)")
+
+
+class HashingReader(object):
+	def __init__(self, f):
+		self.f = f
+		self.h = hashlib.sha256()
+
+	def read(self, size=-1):
+		data = self.f.read(size)
+		self.h.update(data)
+		return data
+
+
+class HashingWriter(object):
+	def __init__(self, f):
+		self.f = f
+		self.size = 0
+		self.h = hashlib.sha256()
+
+	def write(self, data):
+		self.f.write(data)
+		self.h.update(data)
+		self.size += len(data)
+		return len(data)
+
+
+def _copy_members(src, dst, excluded, manifest):
+	for member in src:
+		if excluded is not None and excluded.search(member.name):
+			continue
+		if member.isreg():
+			reader = HashingReader(src.extractfile(member))
+			dst.addfile(member, reader)
+			manifest.append((reader.h.hexdigest(), member.name))
+		else:
+			dst.addfile(member)
+
+
+def copy_tar(fileobj, out, excluded=None):
+	"""
+	Copy a tar stream, leaving out the files whose name matches `excluded`
+	:return: manifest, list of (SHA-256, name) of the regular files
+	"""
+	manifest = list()
+	with tarfile.open(fileobj=fileobj, mode="r|") as src, \
+	 tarfile.open(fileobj=out, mode="w|") as dst:
+		_copy_members(src, dst, excluded, manifest)
+	return manifest
+
+
+def copy_tar_output(cmd, out, excluded=None):
+	"""
+	`copy_tar()` of the output of a command
+	"""
+	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+	try:
+		return copy_tar(proc.stdout, out, excluded)
+	finally:
+		proc.stdout.close()
+		err = proc.wait()
+		if err != 0:
+			raise RuntimeError("{} returned {}".format(" ".join(cmd), err))
+
+
+def write_manifest(path, manifest):
+	with io.open(path + ".manifest", "w", encoding="utf-8") as f:
+		for digest, filename in manifest:
+			f.write("{}  {}\n".format(digest, filename))
+
+
+def file_sha256(path):
+	h = hashlib.sha256()
+	with io.open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1 << 20), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def read_sha256(path):
+	"""
+	:return: SHA-256 of a file, from its `.sha256` file if there is one
+	"""
+	if os.path.exists(path + ".sha256"):
+		with io.open(path + ".sha256", "r", encoding="utf-8") as f:
+			return f.read().split()[0]
+	return file_sha256(path)
+
+
+def read_manifest(path):
+	"""
+	:return: manifest of a tarball, list of (SHA-256, name)
+	"""
+	with io.open(path + ".manifest", "r", encoding="utf-8") as f:
+		return [tuple(x.rstrip("\n").split("  ", 1)) for x in f if x.strip()]
+
+
+def docker_tarball(name, out, path=None):
+	"""
+	Write the `docker save` tarball of an image, and if `path` is given,
+	the SHA-256 of its files (layers, configuration) in `<path>.manifest`.
+
+	:param out: binary file
+	"""
+	cmd = ["docker", "save", name]
+	manifest = copy_tar_output(cmd, out)
+	if path is not None:
+		write_manifest(path, manifest)
+
+
+def image_env(name):
+	"""
+	:return: dict of the environment variables of an image
+	"""
+	cmd = ["docker", "image", "inspect", "--format", "{{json .Config.Env}}", name]
+	env = json.loads(subprocess.check_output(cmd).decode())
+	return dict(x.split("=", 1) for x in env)
+
+
+def offline_tarball(name, out, path=None):
+	"""
+	Write the tarball of the SCT installation of an image and of its
+	datasets (`sct_docker.datasets`, as downloaded in /home/sct), or of
+	the datasets of a data image (see `sct_docker.generate_data()`), to
+	be extracted in /home/sct, read from a created (not started) container.
+
+	Files matching `offline_excluded` are left out, and if `path` is
+	given, the SHA-256 of the files is written in `<path>.manifest`
+	(`sha256sum -c` can verify an extracted archive).
+
+	:param out: binary file
+	"""
+	env = image_env(name)
+	sct_dir = env.get("SCT_DIR", env.get("SCT_DATA"))
+	if not sct_dir:
+		raise RuntimeError("{} has no SCT_DIR".format(name))
+
+	paths = [sct_dir]
+	if "SCT_DIR" in env:
+		paths += ["/home/sct/{}".format(x) for x in datasets]
+
+	manifest = list()
+	container = subprocess.check_output(["docker", "create", name]).decode().strip()
+	try:
+		with tarfile.open(fileobj=out, mode="w|") as dst:
+			for src_path in paths:
+				cmd = ["docker", "cp", "{}:{}".format(container, src_path), "-"]
+				proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+				try:
+					empty = not proc.stdout.peek(1)
+					if not empty:
+						with tarfile.open(fileobj=proc.stdout, mode="r|") as src:
+							_copy_members(src, dst, offline_excluded, manifest)
+				finally:
+					proc.stdout.close()
+					err = proc.wait()
+				if err != 0 and empty and src_path != sct_dir:
+					logger.warning("%s has no %s, not in its offline tarball", name, src_path)
+				elif err != 0:
+					raise RuntimeError("{} returned {}".format(" ".join(cmd), err))
+	finally:
+		subprocess.call(["docker", "rm", "--force", "--volumes", container], stdout=subprocess.DEVNULL)
+
+	if path is not None:
+		write_manifest(path, manifest)
+
+
+# How to produce the uncompressed tarball of an image
+sources = collections.OrderedDict((
+ ("docker", docker_tarball),
+ ("offline", offline_tarball),
+))
+
+
+class MemoryBudget(object):
+	"""
+	Blocking reservation of a memory amount, so that concurrent
+	compressors don't exceed a budget.
+	"""
+	def __init__(self, total):
+		self.total = total
+		self.free = total
+		self.cond = threading.Condition()
+
+	def acquire(self, amount):
+		with self.cond:
+			while amount > self.free:
+				self.cond.wait()
+			self.free -= amount
+
+	def release(self, amount):
+		with self.cond:
+			self.free += amount
+			self.cond.notify_all()
+
+
+def export(name, source, compressor=default_compressor, threads=1, path=None):
+	"""
+	Stream the tarball of an image through a compressor into a file,
+	and write its SHA-256 next to it (as `<file>.sha256`, in the
+	`sha256sum` format).
+
+	:param source: kind of tarball, one of `sources`
+	:param threads: compressor threads
+	:return: dict with path, input/output sizes and duration
+	"""
+
+	comp = compressors[compressor]
+
+	if path is None:
+		path = "{}-{}.tar{}".format(name, source, comp.ext)
+
+	t0 = time.time()
+
+	cmp = subprocess.Popen([comp.exe] + comp.args(threads),
+	 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+	writer = HashingWriter(cmp.stdin)
+	errors = list()
+
+	def pump():
+		try:
+			sources[source](name, writer, path)
+		except BrokenPipeError:
+			pass
+		except (RuntimeError, OSError, subprocess.CalledProcessError, tarfile.TarError) as e:
+			errors.append(e)
+		finally:
+			cmp.stdin.close()
+
+	pumper = threading.Thread(target=pump)
+	pumper.start()
+
+	h = hashlib.sha256()
+	size_out = 0
+	try:
+		with io.open(path + ".part", "wb") as f:
+			for chunk in iter(lambda: cmp.stdout.read(1 << 20), b""):
+				h.update(chunk)
+				f.write(chunk)
+				size_out += len(chunk)
+	finally:
+		pumper.join()
+		err_cmp = cmp.wait()
+
+	if errors or err_cmp != 0:
+		os.unlink(path + ".part")
+		raise RuntimeError("Exporting {} failed: {}, {} returned {}".format(
+		 path, errors, comp.exe, err_cmp))
+
+	os.rename(path + ".part", path)
+
+	with io.open(path + ".sha256", "w", encoding="utf-8") as f:
+		f.write("{}  {}\n".format(h.hexdigest(), os.path.basename(path)))
+
+	res = dict(path=path, size_in=writer.size, size_out=size_out,
+	 duration=time.time() - t0, sha256=h.hexdigest())
+
+	logger.info("%s: %.1fM -> %.1fM (%.1f%%) in %.1fs, %.1fM/s",
+	 path, res["size_in"] / 1e6, res["size_out"] / 1e6,
+	 100.0 * res["size_out"] / max(1, res["size_in"]),
+	 res["duration"], res["size_in"] / 1e6 / max(1e-3, res["duration"]))
+
+	return res
+
+
+class Exporter(object):
+	"""
+	Concurrent exports within a memory budget, to which images can be
+	submitted as they become available.
+
+	The CPUs are split between concurrent exports; an export waits until
+	the memory its compressor threads need is available.
+	"""
+	def __init__(self, sources, compressor=default_compressor, jobs=None, memory=None):
+		"""
+		:param sources: kinds of tarballs to produce for each image
+		:param jobs: concurrent exports (default: number of CPUs)
+		:param memory: memory budget in bytes (default: half the physical memory)
+		"""
+		self.sources = sources
+		self.compressor = compressor
+
+		comp = compressors[compressor]
+		if not check_exe(comp.exe):
+			raise RuntimeError("You might want to have {} available when running this tool".format(comp.exe))
+
+		cpus = os.cpu_count() or 1
+		if jobs is None:
+			jobs = cpus
+		jobs = max(1, jobs)
+
+		if memory is None:
+			memory = (available_memory() or (4 << 30)) // 2
+
+		self.threads = max(1, cpus // jobs)
+		self.threads = max(1, min(self.threads, memory // comp.memory))
+		self.reservation = min(memory, self.threads * comp.memory)
+
+		logger.info("Exporting %d at a time, %d %s threads each",
+		 jobs, self.threads, compressor)
+
+		self.budget = MemoryBudget(memory)
+		self.pool = multiprocessing.pool.ThreadPool(jobs)
+		self.promises = list()
+
+	def work(self, name, source):
+		self.budget.acquire(self.reservation)
+		try:
+			return export(name, source, compressor=self.compressor, threads=self.threads)
+		finally:
+			self.budget.release(self.reservation)
+
+	def submit(self, name):
+		for source in self.sources:
+			self.promises.append(((name, source),
+			 self.pool.apply_async(self.work, (name, source))))
+
+	def wait(self):
+		"""
+		Wait for the submitted exports
+		:return: list of results of `export()`
+		"""
+		try:
+			res = list()
+			errors = list()
+			for task, promise in self.promises:
+				try:
+					res.append(promise.get())
+				except RuntimeError as e:
+					logger.error("%s", e)
+					errors.append(task)
+			self.pool.close()
+		finally:
+			self.pool.terminate()
+		self.pool.join()
+
+		if errors:
+			raise RuntimeError("Failed exporting {}".format(errors))
+
+		return res
+
+
+def export_images(names, sources, compressor=default_compressor,
+ jobs=None, memory=None):
+	"""
+	Export images in parallel, within a memory budget (see `Exporter`).
+
+	:return: list of results of `export()`
+	"""
+
+	tasks = len(names) * len(sources)
+	if not tasks:
+		return []
+
+	if jobs is None:
+		jobs = os.cpu_count() or 1
+
+	exporter = Exporter(sources, compressor=compressor,
+	 jobs=min(jobs, tasks), memory=memory)
+	for name in names:
+		exporter.submit(name)
+	return exporter.wait()
+
+
+def benchmark(name, source="docker", candidates=None, threads=None):
+	"""
+	Compare compressors on the tarball of a real image: ratio,
+	compression and decompression speed.
+
+	:param candidates: compressor names (default: the available ones)
+	:return: list of (compressor, size, compression time, decompression time)
+	"""
+
+	if candidates is None:
+		candidates = [x for x, c in compressors.items() if check_exe(c.exe)]
+
+	if threads is None:
+		threads = os.cpu_count() or 1
+
+	rows = list()
+	with tempfile.TemporaryDirectory() as tmp:
+		tarball = os.path.join(tmp, "image.tar")
+		with io.open(tarball, "wb") as f:
+			sources[source](name, f)
+		size = os.path.getsize(tarball)
+
+		for compressor in candidates:
+			comp = compressors[compressor]
+			logger.info("Benchmarking %s", compressor)
+			out = tarball + comp.ext
+
+			t0 = time.time()
+			with io.open(tarball, "rb") as fi, io.open(out, "wb") as fo:
+				subprocess.check_call([comp.exe] + comp.args(threads), stdin=fi, stdout=fo)
+			t1 = time.time()
+			with io.open(out, "rb") as fi:
+				subprocess.check_call([comp.exe, "-d", "-c"], stdin=fi, stdout=subprocess.DEVNULL)
+			t2 = time.time()
+
+			rows.append((compressor, os.path.getsize(out), t1 - t0, t2 - t1))
+			os.unlink(out)
+
+	printf("{} ({}): {:.1f}M\n".format(name, source, size / 1e6))
+	printf("{:<8} {:>10} {:>7} {:>9} {:>10} {:>10}\n".format(
+	 "", "size", "ratio", "time", "compress", "decompress"))
+	for compressor, out, tc, td in rows:
+		printf("{:<8} {:>9.1f}M {:>6.1f}% {:>8.1f}s {:>8.1f}M/s {:>8.1f}M/s\n".format(
+		 compressor, out / 1e6, 100.0 * out / max(1, size), tc,
+		 size / 1e6 / max(1e-3, tc), size / 1e6 / max(1e-3, td)))
+
+	return rows
@@ -2,12 +2,18 @@
 # -*- coding: utf-8 vi:noet
 # Testing using Docker
 
-import sys, io, os, logging, time, datetime, shutil, datetime, subprocess
-import threading
-import multiprocessing.pool
+import sys, io, os, re, json, logging, time, datetime, shutil, datetime, subprocess
+import collections, hashlib, shlex
 
 import sct_docker
+import sct_docker_artifacts
+import sct_docker_delta
+import sct_docker_export
+import sct_docker_publish
+import sct_docker_size
+import sct_docker_trace
 from sct_docker import printf, check_exe
+from sct_docker_build import build_images, image_size, buildkit_available, parse_size
 
 logger = logging.getLogger(__name__)
 
@@ -37,15 +43,184 @@ default_version = "master"
 default_commands = (
 )
 
+def _write_dockerfile(name, lines):
+	if not os.path.exists(name):
+		os.makedirs(name)
+	with io.open(os.path.join(name, "Dockerfile"), "wb") as f:
+		f.write("".join(x + "\n" for x in lines).encode("utf-8"))
+
+
+def _write_inputs(name, base):
+	"""
+	Give an intermediate image the inputs of an image built on it that
+	its build needs (its proxy, see `sct_docker_build.proxy_args()`)
+	"""
+	path = os.path.join(name, "inputs.json")
+	if not os.path.exists(path):
+		return
+	with io.open(path, "r", encoding="utf-8") as f:
+		inputs = json.load(f)
+	inputs = dict((k, inputs[k]) for k in ("distro", "mirrors") if k in inputs)
+	with io.open(os.path.join(base, "inputs.json"), "w", encoding="utf-8") as f:
+		f.write(json.dumps(inputs, sort_keys=True, indent=1))
+
+
+def _rebase(line, base):
+	"""
+	:return: FROM instruction line using another image, keeping the stage name
+	"""
+	return re.sub(r"^FROM\s+\S+", "FROM {}".format(base), line)
+
+
+def _build_args(lines):
+	"""
+	:return: ARG instructions among lines, to be declared again in an
+	 image built FROM them (build arguments aren't inherited)
+	"""
+	return [x for x in lines if x.startswith("ARG ")]
+
+
+def plan_base_images(names):
+	"""
+	Factor the common Dockerfile prefixes of the images into a tree of
+	intermediate images, and rewrite the Dockerfiles FROM them.
+
+	Images sharing a prefix get an intermediate image with the longest
+	common prefix, then the process is repeated on the groups of images
+	that share more (eg. flavors of the same distro, then versions of the
+	same flavor, so that only the SCT installation is specific).
+	The build arguments (eg. mirrors) of a factored prefix are declared
+	again after the FROM of the images built on it.
+
+	:param names: image names (directories containing a Dockerfile)
+	:return: list of stages, each a list of base image names which can be
+	 built once the previous stages are built
+	"""
+
+	stages = list()
+
+	def plan(members, depth, parent, level):
+		n = len(os.path.commonprefix([lines for name, lines in members]))
+		# Only factor the first stage of multi-stage Dockerfiles
+		for idx, line in enumerate(members[0][1][1:n]):
+			if line.startswith("FROM "):
+				n = idx + 1
+				break
+		if len(members) > 1 \
+		 and any(x.startswith(("RUN ", "COPY ", "ADD ")) for x in members[0][1][depth:n]):
+			lines = members[0][1][depth:n]
+			if parent is not None:
+				lines = [_rebase(members[0][1][0], parent)] + _build_args(members[0][1][1:depth]) + lines
+			digest = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+			distro = members[0][1][0].split()[1]
+			base = "sct-base-{}-{}".format(re.sub(r"[:/@]", "-", distro), digest[:12]).lower()
+			_write_dockerfile(base, headers[members[0][0]] + lines)
+			_write_inputs(members[0][0], base)
+			if any("artifacts" in x for x in lines):
+				# Build context
+				shutil.rmtree(os.path.join(base, "artifacts"), ignore_errors=True)
+				shutil.copytree(os.path.join(members[0][0], "artifacts"),
+				 os.path.join(base, "artifacts"), copy_function=os.link)
+			while len(stages) <= level:
+				stages.append(list())
+			stages[level].append(base)
+			parent, depth, level = base, n, level + 1
+
+		groups = collections.OrderedDict()
+		for name, lines in members:
+			groups.setdefault(tuple(lines[n:n+1]), []).append((name, lines))
+
+		for group in groups.values():
+			if len(group) > 1 and len(groups) > 1:
+				plan(group, depth, parent, level)
+				continue
+			if parent is None:
+				continue
+			for name, lines in group:
+				_write_dockerfile(name, headers[name] + [_rebase(lines[0], parent)]
+				 + _build_args(lines[1:depth]) + lines[depth:])
+
+	members = list()
+	headers = dict()
+	for name in names:
+		with io.open(os.path.join(name, "Dockerfile"), "r", encoding="utf-8") as f:
+			lines = f.read().splitlines()
+		# Parser directives (eg. for BuildKit) are kept in every Dockerfile
+		headers[name] = [x for x in lines if x.startswith("# syntax=")]
+		members.append((name, [x for x in lines if not x.startswith("# syntax=")]))
+
+	groups = collections.OrderedDict()
+	for name, lines in members:
+		groups.setdefault((tuple(headers[name]), lines[0]), []).append((name, lines))
+
+	for group in groups.values():
+		plan(group, 0, None, 0)
+
+	return stages
+
+
 def generate(distros=None, version=None,
  jobs=None,
  publish_under=None,
+ publish_jobs=4,
+ publish_insecure=False,
  generate_docker_tarball=False,
  generate_distro_specific_sct_tarball=False,
  build_options=[],
- proxy=False,
+ mirrors=None,
+ compact=False,
+ multistage=False,
+ cache_mounts=False,
+ precompile=False,
+ artifacts_store=None,
+ shared_data=False,
+ shared_base=True,
+ force=False,
+ compressor=sct_docker_export.default_compressor,
+ export_jobs=None,
+ export_memory=None,
+ cpus=None,
+ memory=None,
+ trace_path="build-trace.json",
+ progress=True,
+ fail_fast=False,
+ network_retries=3,
+ pipeline=False,
+ delta_from=None,
  ):
 	"""
+	:param version: SCT version, or list of versions
+	:param publish_under: repository where to push the images
+	 (unchanged images are skipped)
+	:param publish_jobs: concurrent pushes
+	:param publish_insecure: the registry is insecure (eg. a local one)
+	:param shared_base: build the common Dockerfile prefixes once,
+	 as intermediate images (see `plan_base_images()`)
+	:param force: build images even if they are up to date
+	:param mirrors: local proxy/mirrors to use during the build
+	 (see `sct_docker.generate()`)
+	:param cache_mounts: keep downloads in BuildKit cache mounts, if available
+	:param precompile: precompile the Python modules and warm the first-run
+	 caches in the images (see `sct_docker.generate()`)
+	:param artifacts_store: directory where to fetch the SCT sources and
+	 datasets once, instead of downloading them in every image
+	:param shared_data: put the datasets of each version in one data image
+	 (`sct-<version>-data`, see `sct_docker.generate_data()`), built,
+	 published and exported along the images, instead of in every image;
+	 they are fetched in `artifacts_store` (by default ~/.cache/sct-docker/artifacts)
+	:param cpus: CPU budget of the concurrent builds
+	:param memory: memory budget of the concurrent builds, in bytes
+	:param trace_path: where to write the Chrome trace of the builds
+	:param progress: show a status per image rather than the build output
+	:param fail_fast: stop all the builds as soon as one fails
+	:param network_retries: retries of builds failing on network errors
+	:param pipeline: publish and export each image as soon as it's built,
+	 rather than after all the builds
+	:param compressor: compressor of the tarballs (see `sct_docker_export`)
+	:param export_jobs: concurrent tarball exports
+	:param export_memory: memory budget of the tarball exports, in bytes
+	:param delta_from: previous version, against which to make deltas of
+	 the tarballs (its tarballs being in the current directory)
 	"""
 
 	if distros is None:
@@ -54,127 +229,382 @@ def generate(distros=None, version=None,
 	if version is None:
 		version = default_version
 
-	logger.info("Generating distro Dockerfiles")
-	names = []
-	for distro in distros:
-		name = "sct-{}-{}".format(version, distro.replace(":", "-")).lower()
-		logger.info("- %s...", name)
-
-		lock = threading.Lock() # prevent building official simultaneously to alias
-
-		name = sct_docker.generate(distro=distro, version=version,
-		 name=name, commands=default_commands,
-		 install_fsleyes=True,
-		 install_tools=True,
-		 install_python=True,
-		 #install_fsl=True,
-		 configure_ssh=True,
-		 verbose=False,
-		 proxy=proxy,
-		)
+	if isinstance(version, str):
+		versions = [version]
+	else:
+		versions = list(version)
 
-		names.append((name, lock))
+	if cache_mounts and not buildkit_available():
+		logger.warning("BuildKit is not available, not using cache mounts")
+		cache_mounts = False
 
-		if distro == "official":
-			name = "sct-{}-{}".format(version, "official").lower()
-			logger.info("- %s...", name)
+	if shared_data and not buildkit_available():
+		# The data images bind mount the artifacts
+		logger.warning("BuildKit is not available, not sharing the data")
+		shared_data = False
 
-			name = sct_docker.generate(distro=official_distro, version=version,
-			 name=name, commands=default_commands,
-			 install_fsleyes=True,
-			 #install_fsl=True,
-			 configure_ssh=True,
+	if shared_data and not artifacts_store:
+		artifacts_store = os.path.join(os.path.expanduser("~"), ".cache", "sct-docker", "artifacts")
+
+	artifacts = dict()
+	if artifacts_store and not buildkit_available():
+		# They are bind mounted in the builds
+		logger.warning("BuildKit is not available, not using the artifacts store")
+		artifacts_store = None
+	if artifacts_store:
+		logger.info("Fetching artifacts")
+		artifacts = sct_docker_artifacts.populate(artifacts_store, versions, jobs=jobs)
+		logger.info("Done fetching artifacts")
+
+	logger.info("Generating distro Dockerfiles")
+	names = []
+	delta_bases = dict()
+	for version in versions:
+		if shared_data:
+			name = "sct-{}-data".format(version).lower()
+			logger.info("- %s...", name)
+			name = sct_docker.generate_data(version=version, name=name,
+			 artifacts=artifacts.get(version),
 			 verbose=False,
-			 proxy=proxy,
 			)
+			names.append(name)
+			if delta_from is not None and version != delta_from:
+				delta_bases[name] = "sct-{}-data".format(delta_from).lower()
 
-			names.append((name, lock))
+		for distro in distros:
+			name = "sct-{}-{}".format(version, distro.replace(":", "-")).lower()
+			logger.info("- %s...", name)
+
+			if distro == "official":
+				name = sct_docker.generate(distro=official_distro, version=version,
+				 name=name, commands=default_commands,
+				 install_fsleyes=True,
+				 #install_fsl=True,
+				 configure_ssh=True,
+				 verbose=False,
+				 mirrors=mirrors,
+				 compact=compact,
+				 multistage=multistage,
+				 cache_mounts=cache_mounts,
+				 precompile=precompile,
+				 shared_data=shared_data,
+				 artifacts=artifacts.get(version),
+				)
+			else:
+				name = sct_docker.generate(distro=distro, version=version,
+				 name=name, commands=default_commands,
+				 install_fsleyes=True,
+				 install_tools=True,
+				 install_python=True,
+				 #install_fsl=True,
+				 configure_ssh=True,
+				 verbose=False,
+				 mirrors=mirrors,
+				 compact=compact,
+				 multistage=multistage,
+				 cache_mounts=cache_mounts,
+				 precompile=precompile,
+				 shared_data=shared_data,
+				 artifacts=artifacts.get(version),
+				)
+
+			names.append(name)
+			if delta_from is not None and version != delta_from:
+				delta_bases[name] = "sct-{}-{}".format(delta_from, distro.replace(":", "-")).lower()
 
 	logger.info("Done generating distro Dockerfiles")
 
+	stages = []
+	if shared_base:
+		logger.info("Factoring common Dockerfile prefixes")
+		stages = plan_base_images(names)
+		for stage in stages:
+			for base in stage:
+				logger.info("- %s", base)
+	stages.append(names)
+
 	logger.info("Building images")
 
 	if not check_exe("docker"):
 		raise RuntimeError("You might want to have docker available when running this tool")
 
-	pool = multiprocessing.pool.ThreadPool(jobs)
-
-	try:
-		res = list()
-		for name, lock in names:
+	export_sources = []
+	if generate_docker_tarball:
+		export_sources.append("docker")
+	if generate_distro_specific_sct_tarball:
+		export_sources.append("offline")
 
-			cmd = [
-			 "docker", "build",
-			 "-t", name, name,
-			] + build_options
+	# In pipelined mode, images are published/exported as soon as built
+	consumers = []
+	if pipeline and publish_under:
+		consumers.append(sct_docker_publish.Publisher(publish_under,
+		 jobs=publish_jobs,
+		 insecure=publish_insecure,
+		))
+	if pipeline and export_sources:
+		consumers.append(sct_docker_export.Exporter(export_sources,
+		 compressor=compressor,
+		 jobs=export_jobs,
+		 memory=export_memory,
+		))
 
-			def docker_build(cmd, lock):
-				with lock:
-					return subprocess.call(cmd)
+	def on_built(name):
+		if name in names:
+			for consumer in consumers:
+				consumer.submit(name)
 
-			promise = pool.apply_async(docker_build, (cmd, lock))
-			res.append(promise)
+	failed = False
+	t0 = time.time()
+	try:
+		for stage in stages:
+			errs = build_images(stage, jobs=jobs, build_options=build_options, force=force,
+			 cpus=cpus, memory=memory, progress=progress,
+			 fail_fast=fail_fast, retries=network_retries,
+			 on_built=on_built)
 
-		errs = list()
-		for (name, _), promise in zip(names, res):
-			err = promise.get()
-			if err != 0:
-				logger.error("{} failed with error code {}".format(name, err))
-			errs.append(err)
+			for name, err in zip(stage, errs):
+				if err == 0:
+					logger.info("{} finished successfully".format(name))
+				elif err is None:
+					logger.error("{} was cancelled".format(name))
+					failed = True
+				else:
+					logger.error("{} failed with error code {}".format(name, err))
+					failed = True
 
-		pool.close()
+			if failed:
+				logger.error("Not proceeding further as one distro failed: %s", errs)
+				break
 	finally:
-		pool.terminate()
-	pool.join()
-	logger.info("Done building images")
+		sct_docker_trace.report(sum(stages, []), since=t0, path=trace_path)
 
-	failed = False
-	for (name,_), err in zip(names, errs):
-		if err == 0:
-			logger.info("{} finished successfully".format(name))
-		else:
-			logger.error("{} failed with error code {}".format(name, err))
-			failed = True
+	if consumers:
+		logger.info("Waiting for publishing/tarballs of the built images")
+		errors = list()
+		for consumer in consumers:
+			try:
+				consumer.wait()
+			except RuntimeError as e:
+				errors.append(e)
+		if errors:
+			raise RuntimeError("Failed publishing/generating tarballs: {}".format(errors))
 
 	if failed:
-		logger.error("Not proceeding further as one distro failed: %s", errs)
 		raise RuntimeError("Failed generating one distro")
 
-	if proxy:
-		return
+	logger.info("Done building images")
 
-	if publish_under:
+	if publish_under and not pipeline:
 		logger.info("Publishing on Docker hub")
-		for name,_ in names:
-			logger.info("- %s...", name)
-			cmd = ["docker", "tag", name, "{}:{}".format(publish_under, name)]
-			subprocess.call(cmd)
-			cmd = ["docker", "push", "{}:{}".format(publish_under, name)]
-			subprocess.call(cmd)
-
+		sct_docker_publish.publish_images(names, publish_under,
+		 jobs=publish_jobs,
+		 insecure=publish_insecure,
+		)
 		logger.info("Done publishing")
 
-	if generate_docker_tarball:
-		logger.info("Generating Docker tarballs")
-		for name,_ in names:
-			logger.info("- %s...", name)
-			cmd = ["bash", "-c", "docker save {}" \
-			 " | xz --threads=0 --best > {}-docker.tar.xz".format(name, name)]
-			subprocess.call(cmd)
-		logger.info("Done generating Docker tarballs")
+	if export_sources and not pipeline:
+		logger.info("Generating tarballs")
+		sct_docker_export.export_images(names, export_sources,
+		 compressor=compressor,
+		 jobs=export_jobs,
+		 memory=export_memory,
+		)
+		logger.info("Done generating tarballs")
 
-	if generate_distro_specific_sct_tarball:
+	delta_pairs = []
+	ext = sct_docker_export.compressors[compressor].ext
+	for name, base in delta_bases.items():
+		for source in export_sources:
+			target = "{}-{}.tar{}".format(name, source, ext)
+			base_path = "{}-{}.tar{}".format(base, source, ext)
+			if not os.path.exists(base_path + ".manifest"):
+				logger.warning("No %s (with its manifest), not making a delta of %s", base_path, target)
+				continue
+			delta_pairs.append((base_path, target, sct_docker_delta.delta_path(target, delta_from)))
+	if delta_pairs:
+		logger.info("Generating delta tarballs")
+		sct_docker_delta.make_deltas(delta_pairs, jobs=export_jobs)
+		logger.info("Done generating delta tarballs")
 
-		logger.info("Generating offline archives")
-		if not (check_exe("xz") and check_exe("bash")):
-			raise RuntimeError("You might want to have bash & xz available when running this tool")
-		for name,_ in names:
-			logger.info("- %s...", name)
-			cmd = ["bash", "-c", "docker run --log-driver=none --entrypoint /bin/sh {} -c 'cd /home/sct; tar c sct_*'" \
-			 " | xz --threads=0 --best > {}-offline.tar.xz".format(name, name)]
-			subprocess.call(cmd)
 
-		logger.info("Done generating offline archives")
+def compare_compact(distros=None, version=None, build=False, build_options=[]):
+	"""
+	Report how many layers (and bytes, when building) compact mode saves
+	compared to the regular Dockerfiles.
+
+	:param build: build both variants to measure the image sizes
+	:return: list of (distro, layers, compact layers, size, compact size)
+	"""
+
+	if distros is None:
+		distros = default_distros
+
+	if version is None:
+		version = default_version
+
+	if build and not check_exe("docker"):
+		raise RuntimeError("You might want to have docker available when running this tool")
+
+	rows = list()
+	for distro in distros:
+		row = [distro]
+		layers = list()
+		sizes = list()
+		for compact in (False, True):
+			name = "sct-{}-{}-{}".format(version, distro.replace(":", "-"),
+			 "compact" if compact else "regular").lower()
+			name = sct_docker.generate(
+			 distro=official_distro if distro == "official" else distro,
+			 version=version, name=name, commands=default_commands,
+			 install_fsleyes=True,
+			 install_tools=True,
+			 install_python=True,
+			 configure_ssh=True,
+			 verbose=False,
+			 compact=compact,
+			)
+			layers.append(len(sct_docker.dockerfile_layers(name)))
+			if build:
+				cmd = ["docker", "build", "-t", name, name] + build_options
+				if subprocess.call(cmd) != 0:
+					logger.error("%s failed to build", name)
+				sizes.append(image_size(name))
+			else:
+				sizes.append(None)
+		rows.append((distro, layers[0], layers[1], sizes[0], sizes[1]))
+
+	def fmt(x):
+		return "-" if x is None else "{:.1f}M".format(x / 1e6)
+
+	printf("{:<14} {:>7} {:>7} {:>7} {:>10} {:>10} {:>10}\n".format(
+	 "distro", "layers", "compact", "saved", "size", "compact", "saved"))
+	for distro, l0, l1, s0, s1 in rows:
+		saved = None if None in (s0, s1) else s0 - s1
+		printf("{:<14} {:>7} {:>7} {:>7} {:>10} {:>10} {:>10}\n".format(
+		 distro, l0, l1, l0 - l1, fmt(s0), fmt(s1), fmt(saved)))
+
+	return rows
+
+
+# First SCT command of `benchmark_startup()`
+default_startup_command = "sct_download_data -h"
+
+# Commands of `compare_precompile()`
+default_startup_commands = (
+ "sct_check_dependencies -short",
+ "sct_propseg -h",
+ "sct_register_multimodal -h",
+ "sct_deepseg_sc -h",
+)
+
+
+def _median(f, runs):
+	times = sorted(f() for run in range(runs))
+	return times[len(times) // 2]
+
+
+def _time_call(cmd):
+	t0 = time.time()
+	err = subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	if err != 0:
+		raise RuntimeError("{} returned {}".format(" ".join(cmd), err))
+	return time.time() - t0
+
+
+def _time_ready(name):
+	t0 = time.time()
+	container = subprocess.check_output(["docker", "run", "-d", "--env", "SCT_SSHD=1",
+	 name, "sleep", "infinity"]).decode().strip()
+	try:
+		while subprocess.call(["docker", "exec", container, "test", "-e", sct_docker.ready_path],
+		 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+			time.sleep(0.05)
+		return time.time() - t0
+	finally:
+		subprocess.call(["docker", "rm", "--force", container], stdout=subprocess.DEVNULL)
+
+
+def benchmark_startup(names, command=default_startup_command, runs=5):
+	"""
+	Measure the latency from a container start to the end of a first SCT
+	command (median of `runs`): run directly by the entrypoint, and in an
+	interactive bash (as before the entrypoint); and until an
+	entrypoint started sshd and signalled that it's ready.
+
+	:return: list of (image, direct, interactive, sshd ready) in seconds
+	"""
+
+	if not check_exe("docker"):
+		raise RuntimeError("You might want to have docker available when running this tool")
+
+	rows = list()
+	for name in names:
+		logger.info("Benchmarking %s", name)
+		direct = _median(lambda: _time_call(["docker", "run", "--rm", name] + shlex.split(command)), runs)
+		interactive = _median(lambda: _time_call(["docker", "run", "--rm",
+		 "--entrypoint", "/bin/bash", name, "-i", "-c", command]), runs)
+		ready = _median(lambda: _time_ready(name), runs)
+		rows.append((name, direct, interactive, ready))
+
+	printf("{}, median of {} runs\n".format(command, runs))
+	printf("{:<40} {:>8} {:>12} {:>11}\n".format("image", "direct", "interactive", "sshd ready"))
+	for name, direct, interactive, ready in rows:
+		printf("{:<40} {:>7.2f}s {:>11.2f}s {:>10.2f}s\n".format(name, direct, interactive, ready))
+
+	return rows
+
+
+def compare_precompile(distros=None, version=None, commands=default_startup_commands,
+ runs=3, build_options=[]):
+	"""
+	Build images with and without `precompile`, and compare the time
+	from a container start to the end of SCT commands (median of `runs`).
+
+	:return: list of (distro, command, regular time, precompiled time)
+	"""
+
+	if distros is None:
+		distros = default_distros
+
+	if version is None:
+		version = default_version
+
+	if not check_exe("docker"):
+		raise RuntimeError("You might want to have docker available when running this tool")
+
+	rows = list()
+	for distro in distros:
+		names = list()
+		for precompile in (False, True):
+			name = "sct-{}-{}-{}".format(version, distro.replace(":", "-"),
+			 "precompiled" if precompile else "regular").lower()
+			name = sct_docker.generate(
+			 distro=official_distro if distro == "official" else distro,
+			 version=version, name=name, commands=default_commands,
+			 install_fsleyes=True,
+			 install_tools=True,
+			 install_python=True,
+			 configure_ssh=True,
+			 verbose=False,
+			 precompile=precompile,
+			)
+			cmd = ["docker", "build", "-t", name, name] + build_options
+			if subprocess.call(cmd) != 0:
+				raise RuntimeError("{} failed to build".format(name))
+			names.append(name)
+
+		for command in commands:
+			times = [_median(lambda: _time_call(["docker", "run", "--rm", name] + shlex.split(command)), runs)
+			 for name in names]
+			rows.append((distro, command, times[0], times[1]))
+
+	printf("{:<14} {:<32} {:>9} {:>11} {:>7}\n".format(
+	 "distro", "command", "regular", "precompiled", "saved"))
+	for distro, command, t0, t1 in rows:
+		printf("{:<14} {:<32} {:>8.2f}s {:>10.2f}s {:>6.1f}%\n".format(
+		 distro, command[:32], t0, t1, 100.0 * (t0 - t1) / max(1e-3, t0)))
+
+	return rows
 
 
 def main():
@@ -206,7 +636,9 @@ def main():
 	)
 
 	subp.add_argument("--version",
-	 default=default_version,
+	 nargs="+",
+	 help="SCT version(s) to build",
+	 default=[default_version],
 	)
 
 	subp.add_argument("--jobs",
@@ -214,6 +646,19 @@ def main():
 	 default=None,
 	)
 
+	subp.add_argument("--cpus",
+	 type=int,
+	 help="CPU budget of the concurrent builds (default: number of CPUs)",
+	 default=None,
+	)
+
+	subp.add_argument("--memory",
+	 type=parse_size,
+	 metavar="SIZE",
+	 help="Memory budget of the concurrent builds (eg. 16G; default: the RAM)",
+	 default=None,
+	)
+
 	subp.add_argument("--generate-docker-tarball",
 	 action="store_true",
 	 default=False,
@@ -224,16 +669,325 @@ def main():
 	 default=False,
 	)
 
+	subp.add_argument("--compressor",
+	 choices=list(sct_docker_export.compressors),
+	 help="Compressor of the tarballs",
+	 default=sct_docker_export.default_compressor,
+	)
+
+	subp.add_argument("--export-jobs",
+	 type=int,
+	 help="Number of tarballs to generate concurrently",
+	 default=None,
+	)
+
+	subp.add_argument("--export-memory",
+	 type=parse_size,
+	 metavar="SIZE",
+	 help="Memory budget of tarball generation (eg. 8G; default: half the RAM)",
+	 default=None,
+	)
+
+	subp.add_argument("--delta-from",
+	 metavar="VERSION",
+	 help="Also make deltas of the tarballs against those of a previous version"
+	  " (in the current directory), to be used with apply-delta",
+	)
+
+	subp.add_argument("--pipeline",
+	 action="store_true",
+	 help="Publish and generate the tarballs of each image as soon as it's built",
+	 default=False,
+	)
+
 	subp.add_argument("--publish-under",
 	 help="Where to publish on docker hub (x/y)",
 	)
 
+	subp.add_argument("--publish-jobs",
+	 type=int,
+	 help="Number of concurrent pushes (default: %(default)s)",
+	 default=4,
+	)
+
+	subp.add_argument("--publish-insecure",
+	 action="store_true",
+	 help="The registry doesn't use TLS (eg. a local registry)",
+	 default=False,
+	)
+
+
+	subp.add_argument("--mirror",
+	 action="append",
+	 type=sct_docker.parse_mirror,
+	 metavar="KIND=URL[,CA_FILE]",
+	 help="Proxy/mirror to use during the build; KIND in: {}".format(", ".join(sct_docker.mirror_kinds)),
+	 default=[],
+	)
+
+	subp.add_argument("--compact",
+	 action="store_true",
+	 help="Group package installations into one transaction per phase",
+	 default=False,
+	)
+
+	subp.add_argument("--multistage",
+	 action="store_true",
+	 help="Build in a separate stage, to leave compilers and headers out of the images",
+	 default=False,
+	)
+
+	subp.add_argument("--precompile",
+	 action="store_true",
+	 help="Precompile the Python modules and warm the first-run caches"
+	  " in the images, for faster SCT command startup",
+	 default=False,
+	)
+
+	subp.add_argument("--cache-mounts",
+	 action="store_true",
+	 help="Keep package downloads between builds (needs BuildKit)",
+	 default=False,
+	)
+
+	subp.add_argument("--artifacts",
+	 dest="artifacts_store",
+	 metavar="DIR",
+	 help="Fetch the SCT sources and datasets once in this directory",
+	)
+
+	subp.add_argument("--shared-data",
+	 action="store_true",
+	 help="Put the datasets in one data image per version (sct-<version>-data)"
+	  " rather than in every image",
+	 default=False,
+	)
+
+	subp.add_argument("--trace",
+	 dest="trace_path",
+	 metavar="FILE",
+	 help="Where to write the Chrome trace of the builds (default: %(default)s)",
+	 default="build-trace.json",
+	)
 
-	subp.add_argument("--proxy",
+	subp.add_argument("--fail-fast",
 	 action="store_true",
+	 help="Stop all the builds as soon as one fails",
 	 default=False,
 	)
 
+	subp.add_argument("--network-retries",
+	 type=int,
+	 help="Retries of builds failing on network errors (default: %(default)s)",
+	 default=3,
+	)
+
+	subp.add_argument("--no-progress",
+	 dest="progress",
+	 action="store_false",
+	 help="Show the build output rather than a status per image (and <image>/build.log)",
+	 default=True,
+	)
+
+	subp.add_argument("--force-build",
+	 dest="force",
+	 action="store_true",
+	 help="Build images even if an image built from the same inputs exists",
+	 default=False,
+	)
+
+	subp.add_argument("--no-shared-base",
+	 dest="shared_base",
+	 action="store_false",
+	 help="Don't build the common Dockerfile prefix as an intermediate image",
+	 default=True,
+	)
+
+	subp = subparsers.add_parser(
+	 "compare-compact",
+	 help="Report layers/bytes saved by --compact for each distro",
+	)
+
+	subp.add_argument("--distros",
+	 nargs="+",
+	 help="Distributions to compare (docker image names)",
+	 default=default_distros,
+	)
+
+	subp.add_argument("--version",
+	 default=default_version,
+	)
+
+	subp.add_argument("--build",
+	 action="store_true",
+	 help="Build both variants to measure the image sizes",
+	 default=False,
+	)
+
+	subp = subparsers.add_parser(
+	 "benchmark-compressors",
+	 help="Compare the compressors on the tarball of an image",
+	)
+
+	subp.add_argument("image",
+	)
+
+	subp.add_argument("--source",
+	 choices=list(sct_docker_export.sources),
+	 default="docker",
+	)
+
+	subp.add_argument("--compressors",
+	 nargs="+",
+	 choices=list(sct_docker_export.compressors),
+	 help="Compressors to compare (default: the available ones)",
+	)
+
+	subp = subparsers.add_parser(
+	 "benchmark-startup",
+	 help="Measure the latency from a container start to a first SCT command",
+	)
+
+	subp.add_argument("images",
+	 nargs="+",
+	)
+
+	subp.add_argument("--command",
+	 dest="startup_command",
+	 help="SCT command (default: %(default)s)",
+	 default=default_startup_command,
+	)
+
+	subp.add_argument("--runs",
+	 type=int,
+	 help="Runs of each measurement (default: %(default)s)",
+	 default=5,
+	)
+
+	subp = subparsers.add_parser(
+	 "compare-precompile",
+	 help="Compare SCT command startup times with and without --precompile",
+	)
+
+	subp.add_argument("--distros",
+	 nargs="+",
+	 help="Distributions to compare (docker image names)",
+	 default=default_distros,
+	)
+
+	subp.add_argument("--version",
+	 default=default_version,
+	)
+
+	subp.add_argument("--commands",
+	 nargs="+",
+	 help="SCT commands (default: {})".format(", ".join(default_startup_commands)),
+	 default=default_startup_commands,
+	)
+
+	subp.add_argument("--runs",
+	 type=int,
+	 help="Runs of each measurement (default: %(default)s)",
+	 default=3,
+	)
+
+	subp = subparsers.add_parser(
+	 "make-delta",
+	 help="Make the delta of a tarball against a previous one",
+	)
+
+	subp.add_argument("base",
+	 help="Previous tarball (with its .manifest)",
+	)
+
+	subp.add_argument("target",
+	 help="Tarball (with its .manifest)",
+	)
+
+	subp.add_argument("--output",
+	 help="Delta tarball",
+	 required=True,
+	)
+
+	subp = subparsers.add_parser(
+	 "apply-delta",
+	 help="Rebuild a tarball from a previous one and a delta",
+	)
+
+	subp.add_argument("base",
+	 help="Previous tarball",
+	)
+
+	subp.add_argument("delta",
+	 help="Delta tarball (with its .json)",
+	)
+
+	subp.add_argument("--output",
+	 help="Rebuilt tarball (default: its original name, next to the delta)",
+	)
+
+	subp = subparsers.add_parser(
+	 "analyze-size",
+	 help="Print the size of images per layer and fragment, and check it",
+	)
+
+	subp.add_argument("images",
+	 nargs="+",
+	 help="Image names (directories)",
+	)
+
+	subp.add_argument("--budgets",
+	 metavar="FILE",
+	 help="JSON file of maximum sizes per distro (eg. {\"official\": \"4G\", \"default\": \"5G\"})",
+	)
+
+	subp.add_argument("--max-growth",
+	 type=float,
+	 metavar="PERCENT",
+	 help="Growth since the previous analysis considered a regression (default: %(default)s)",
+	 default=sct_docker_size.default_max_growth,
+	)
+
+	subp.add_argument("--no-record",
+	 dest="record",
+	 action="store_false",
+	 help="Don't remember the sizes (in {})".format(sct_docker_size.history_path),
+	 default=True,
+	)
+
+	subp = subparsers.add_parser(
+	 "trace-summary",
+	 help="Print the slowest build steps of images",
+	)
+
+	subp.add_argument("images",
+	 nargs="+",
+	 help="Image names (directories)",
+	)
+
+	subp.add_argument("--trace",
+	 dest="trace_path",
+	 metavar="FILE",
+	 help="Also write their Chrome trace",
+	)
+
+	subp = subparsers.add_parser(
+	 "evict-artifacts",
+	 help="Remove the artifacts of versions no longer needed",
+	)
+
+	subp.add_argument("--artifacts",
+	 dest="artifacts_store",
+	 metavar="DIR",
+	 required=True,
+	)
+
+	subp.add_argument("--keep",
+	 nargs="*",
+	 help="Versions to keep",
+	 default=[],
+	)
+
 	try:
 		import argcomplete
 		argcomplete.autocomplete(parser)
@@ -247,9 +1001,56 @@ def main():
 		 generate_docker_tarball=args.generate_docker_tarball,
 		 generate_distro_specific_sct_tarball=args.generate_distro_specific_sct_tarball,
 		 publish_under=args.publish_under,
+		 publish_jobs=args.publish_jobs,
+		 publish_insecure=args.publish_insecure,
 		 jobs=args.jobs,
-		 proxy=args.proxy,
+		 mirrors=dict(args.mirror),
+		 compact=args.compact,
+		 multistage=args.multistage,
+		 cache_mounts=args.cache_mounts,
+		 precompile=args.precompile,
+		 artifacts_store=args.artifacts_store,
+		 shared_data=args.shared_data,
+		 shared_base=args.shared_base,
+		 force=args.force,
+		 compressor=args.compressor,
+		 export_jobs=args.export_jobs,
+		 export_memory=args.export_memory,
+		 cpus=args.cpus,
+		 memory=args.memory,
+		 trace_path=args.trace_path,
+		 progress=args.progress,
+		 fail_fast=args.fail_fast,
+		 network_retries=args.network_retries,
+		 pipeline=args.pipeline,
+		 delta_from=args.delta_from,
 		)
+	elif args.command == "compare-compact":
+		compare_compact(distros=args.distros, version=args.version,
+		 build=args.build)
+	elif args.command == "benchmark-compressors":
+		sct_docker_export.benchmark(args.image, source=args.source,
+		 candidates=args.compressors)
+	elif args.command == "benchmark-startup":
+		benchmark_startup(args.images, command=args.startup_command, runs=args.runs)
+	elif args.command == "compare-precompile":
+		compare_precompile(distros=args.distros, version=args.version,
+		 commands=args.commands, runs=args.runs)
+	elif args.command == "make-delta":
+		sct_docker_delta.make_delta(args.base, args.target, args.output)
+	elif args.command == "apply-delta":
+		sct_docker_delta.apply_delta(args.base, args.delta, path=args.output)
+	elif args.command == "analyze-size":
+		budgets = None
+		if args.budgets:
+			budgets = sct_docker_size.load_budgets(args.budgets)
+		if sct_docker_size.analyze(args.images, budgets=budgets,
+		 max_growth=args.max_growth, record=args.record):
+			return 1
+	elif args.command == "trace-summary":
+		sct_docker_trace.report(args.images, path=args.trace_path)
+	elif args.command == "evict-artifacts":
+		sct_docker_artifacts.evict(args.artifacts_store, args.keep)
 	else:
 		parser.print_help(sys.stderr)
 		return 1
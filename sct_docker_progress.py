@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 vi:noet
+# Live status of concurrent image builds
+
+import sys, logging, time
+import collections, threading
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressView(object):
+	"""
+	Compact status of concurrent builds, one line per image: current step,
+	elapsed time, and how many steps were cached/built.
+
+	On a terminal the lines are redrawn in place; otherwise the status is
+	printed every `interval` seconds, and when a build ends.
+	"""
+	def __init__(self, stream=None, interval=None):
+		if stream is None:
+			stream = sys.stderr
+		self.stream = stream
+		self.tty = stream.isatty()
+		if interval is None:
+			interval = 1 if self.tty else 60
+		self.interval = interval
+		self.lock = threading.RLock()
+		self.images = collections.OrderedDict()
+		self.drawn = 0
+		self.done = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.done.set()
+		if self.thread is not None:
+			self.thread.join()
+		self.draw()
+
+	def add(self, name, trace, status=None):
+		"""
+		Follow a build (or a retry of it)
+		:param trace: `sct_docker_trace.BuildTrace` fed with its output
+		:param status: what it's doing, when it's not building
+		"""
+		with self.lock:
+			self.images[name] = dict(trace=trace, status=None, waiting=status)
+
+	def finish(self, name, status, log=None, tail=None):
+		"""
+		Mark a build as ended
+		:param status: short description ("built", "up to date", "failed (1)")
+		:param log: path of the build log
+		:param tail: last lines of output, printed if the build failed
+		"""
+		with self.lock:
+			image = self.images.setdefault(name, dict(trace=None, status=None))
+			image["status"] = status
+			if self.tty:
+				self.draw()
+			else:
+				self.write([self.line(name, image)])
+			if tail:
+				self.clear()
+				self.write(["--- {} failed, last lines of {}:".format(name, log)]
+				 + [x.rstrip("\n") for x in tail] + ["---"])
+
+	def line(self, name, image, now=None):
+		if now is None:
+			now = time.time()
+		trace = image["trace"]
+		if trace is None:
+			return "{:<40} {}".format(name, image["status"] or image.get("waiting"))
+		steps = trace.steps
+		cached = sum(1 for x in steps if x["cached"])
+		built = sum(1 for x in steps if x["end"] is not None and not x["cached"])
+		elapsed = (trace.end or now) - trace.start
+		if image["status"] is not None:
+			current = image["status"]
+		elif steps:
+			current = steps[-1]["instruction"]
+		else:
+			current = "starting"
+		return "{:<40} {:>4}:{:02} {:>3} cached {:>3} built  {}".format(
+		 name, int(elapsed) // 60, int(elapsed) % 60, cached, built, current)[:160]
+
+	def write(self, lines):
+		for line in lines:
+			self.stream.write(line + "\n")
+		self.stream.flush()
+
+	def clear(self):
+		if self.tty and self.drawn:
+			self.stream.write("\x1b[{}A\x1b[J".format(self.drawn))
+			self.drawn = 0
+
+	def draw(self):
+		with self.lock:
+			lines = [self.line(name, image) for name, image in self.images.items()]
+			if self.tty:
+				self.clear()
+				self.write(lines)
+				self.drawn = len(lines)
+			elif not self.done.is_set():
+				running = [x for x, (name, image) in zip(lines, self.images.items())
+				 if image["status"] is None]
+				if running:
+					self.write(running)
+
+	def run(self):
+		while not self.done.wait(self.interval):
+			self.draw()
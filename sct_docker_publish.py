@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 vi:noet
+# Publishing of built images to a registry
+
+import sys, io, os, re, json, logging, subprocess
+import multiprocessing.pool
+
+from sct_docker import printf
+
+logger = logging.getLogger(__name__)
+
+
+# `docker manifest` is experimental before Docker 20.10
+_env = dict(os.environ, DOCKER_CLI_EXPERIMENTAL="enabled")
+
+
+def _inspect(name, template):
+	cmd = ["docker", "image", "inspect", "--format", template, name]
+	return json.loads(subprocess.check_output(cmd).decode())
+
+
+def remote_manifest(reference, insecure=False):
+	"""
+	:param reference: repository:tag or repository@digest
+	:return: (digest, manifest) of an image in a registry, or None if it
+	 isn't there
+	"""
+	cmd = ["docker", "manifest", "inspect", "--verbose", reference]
+	if insecure:
+		cmd.insert(3, "--insecure")
+	try:
+		out = subprocess.check_output(cmd, env=_env, stderr=subprocess.DEVNULL).decode()
+	except subprocess.CalledProcessError:
+		return None
+	res = json.loads(out)
+	if isinstance(res, list): # manifest list
+		return None
+	manifest = res.get("SchemaV2Manifest") or res.get("SchemaV1Manifest")
+	return res["Descriptor"]["digest"], manifest
+
+
+def publish(name, repository, insecure=False):
+	"""
+	Push an image as `repository:name`, unless the registry already has
+	it (the local image's repo digest is the remote one).
+
+	:param insecure: registry without TLS (eg. a local registry)
+	:return: dict with status ("unchanged" or "pushed"), digest, and
+	 bytes uploaded (compressed size of the layers that were pushed)
+	"""
+
+	reference = "{}:{}".format(repository, name)
+
+	remote = remote_manifest(reference, insecure=insecure)
+	repo_digests = _inspect(name, "{{json .RepoDigests}}") or []
+	if remote is not None and "{}@{}".format(repository, remote[0]) in repo_digests:
+		logger.info("%s is unchanged (%s)", reference, remote[0])
+		return dict(name=name, status="unchanged", digest=remote[0], uploaded=0)
+
+	err = subprocess.call(["docker", "tag", name, reference])
+	if err != 0:
+		raise RuntimeError("Couldn't tag {} as {}: {}".format(name, reference, err))
+
+	proc = subprocess.Popen(["docker", "push", reference],
+	 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	pushed = set()
+	digest = None
+	for line in iter(proc.stdout.readline, b""):
+		line = line.decode("utf-8", "replace").rstrip()
+		logger.debug("%s: %s", reference, line)
+		m = re.match(r"^(?P<id>[0-9a-f]{12}): Pushed$", line)
+		if m is not None:
+			pushed.add(m.group("id"))
+		m = re.search(r"digest: (?P<digest>sha256:[0-9a-f]{64})", line)
+		if m is not None:
+			digest = m.group("digest")
+	err = proc.wait()
+	if err != 0:
+		raise RuntimeError("Couldn't push {}: {}".format(reference, err))
+
+	# The push output names layers by diff ID, which are in the same order
+	# as the (compressed) layers of the manifest
+	uploaded = None
+	remote = remote_manifest("{}@{}".format(repository, digest) if digest else reference,
+	 insecure=insecure)
+	if remote is not None and remote[1] is not None:
+		layers = remote[1].get("layers", [])
+		diff_ids = _inspect(name, "{{json .RootFS.Layers}}")
+		if len(layers) == len(diff_ids):
+			uploaded = sum(layer["size"] for layer, diff_id in zip(layers, diff_ids)
+			 if diff_id.split(":")[-1][:12] in pushed)
+		digest = digest or remote[0]
+
+	logger.info("%s pushed (%s)", reference, digest)
+	return dict(name=name, status="pushed", digest=digest, uploaded=uploaded)
+
+
+class Publisher(object):
+	"""
+	Concurrent pushes, to which images can be submitted as they become
+	available
+	"""
+	def __init__(self, repository, jobs=4, insecure=False):
+		"""
+		:param jobs: concurrent pushes
+		"""
+		self.repository = repository
+		self.insecure = insecure
+		self.pool = multiprocessing.pool.ThreadPool(jobs)
+		self.promises = list()
+
+	def submit(self, name):
+		self.promises.append((name,
+		 self.pool.apply_async(publish, (name, self.repository, self.insecure))))
+
+	def wait(self):
+		"""
+		Wait for the submitted pushes, and print a report
+		:return: list of results of `publish()`
+		"""
+		try:
+			res = list()
+			errors = list()
+			for name, promise in self.promises:
+				try:
+					res.append(promise.get())
+				except (RuntimeError, subprocess.CalledProcessError) as e:
+					logger.error("%s", e)
+					errors.append(name)
+			self.pool.close()
+		finally:
+			self.pool.terminate()
+		self.pool.join()
+
+		print_report(res)
+
+		if errors:
+			raise RuntimeError("Failed publishing {}".format(errors))
+
+		return res
+
+
+def publish_images(names, repository, jobs=4, insecure=False):
+	"""
+	Publish images concurrently (see `Publisher`)
+	:return: list of results of `publish()`
+	"""
+	publisher = Publisher(repository, jobs=jobs, insecure=insecure)
+	for name in names:
+		publisher.submit(name)
+	return publisher.wait()
+
+
+def print_report(results):
+	printf("{:<40} {:<10} {:>10}  {}\n".format("image", "status", "uploaded", "digest"))
+	for x in results:
+		printf("{:<40} {:<10} {:>10}  {}\n".format(x["name"], x["status"],
+		 "-" if x["uploaded"] is None else "{:.1f}M".format(x["uploaded"] / 1e6),
+		 x["digest"]))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 vi:noet
+# Size of images, per layer and per part of the generated Dockerfile
+
+import sys, io, os, re, json, logging, time, subprocess
+import collections
+
+from sct_docker import printf, dockerfile_layers
+from sct_docker_build import image_size, dockerfile_bases, parse_size
+
+logger = logging.getLogger(__name__)
+
+
+# Parts of what `sct_docker.generate()` produces, recognized in the
+# layer instructions (first match)
+fragments = collections.OrderedDict((
+ ("data", re.compile(r"sct_download_data|sct_\w+_data")),
+ ("fsl", re.compile(r"FSLDIR|fsl-\d|/home/sct/fsl\b")),
+ ("fsleyes", re.compile(r"fsleyes|wxPython|pyopengl|\$\{PIP\}|/home/sct/\.local")),
+ ("sct", re.compile(r"install_sct|spinalcordtoolbox|/home/sct/sct_")),
+ ("packages", re.compile(r"apt-get|\byum\b|\bdnf\b|runtime-packages")),
+))
+
+# Where the sizes of the analyzed images are remembered
+history_path = os.path.join(os.path.expanduser("~"), ".cache", "sct-docker", "size-history.json")
+
+# Growth of an image (over its previous analysis) considered a regression
+default_max_growth = 10
+
+
+def fragment(instruction):
+	for name, regex in fragments.items():
+		if regex.search(instruction):
+			return name
+	return "other"
+
+
+def dockerfile_chain(name):
+	"""
+	:return: layer instructions of an image, including those of the
+	 intermediate images it's built FROM (see `plan_base_images()`)
+	"""
+	lines = dockerfile_layers(name)
+	bases = dockerfile_bases(name)
+	if bases and os.path.exists(os.path.join(bases[0], "Dockerfile")):
+		lines = dockerfile_chain(bases[0]) + lines
+	return lines
+
+
+def _matches(instruction, created_by):
+	kind, _, args = instruction.partition(" ")
+	if kind == "RUN":
+		# --mount etc. aren't in the history
+		args = re.sub(r"^(--\S+\s+)*", "", args)
+		return args in created_by
+	# COPY/ADD, the sources are recorded as digests
+	return kind in created_by and args.split()[-1] in created_by
+
+
+def layers(name):
+	"""
+	Map the layers of an image to the Dockerfile instructions that created them
+
+	:return: list of dicts with size (bytes), fragment (one of
+	 `fragments`, "other" or "base image") and instruction, oldest first
+	"""
+	cmd = ["docker", "history", "--no-trunc", "--human=false", "--format", "{{.ID}}\t{{.CreatedBy}}\t{{.Size}}", name]
+	out = subprocess.check_output(cmd).decode("utf-8", "replace")
+	rows = list()
+	for line in reversed(out.splitlines()):
+		if line.count("\t") < 2:
+			continue
+		layer, rest = line.split("\t", 1)
+		created_by, size = rest.rsplit("\t", 1)
+		rows.append((created_by, int(size) if size.isdigit() else 0))
+
+	instructions = dockerfile_chain(name)
+	res = list()
+	pos = 0
+	for created_by, size in rows:
+		for idx in range(pos, len(instructions)):
+			if _matches(instructions[idx], created_by):
+				pos = idx + 1
+				res.append(dict(size=size, fragment=fragment(instructions[idx]),
+				 instruction=instructions[idx]))
+				break
+		else:
+			if size:
+				res.append(dict(size=size, fragment="base image" if pos == 0 else "other",
+				 instruction=created_by.strip()))
+	return res
+
+
+def budget_key(name):
+	"""
+	:return: key of an image in the budgets and history: its name without
+	 the SCT version (eg. "ubuntu-18.04" for "sct-4.2.1-ubuntu-18.04")
+	"""
+	path = os.path.join(name, "inputs.json")
+	if os.path.exists(path):
+		with io.open(path, "r", encoding="utf-8") as f:
+			prefix = "sct-{}-".format(json.load(f)["version"]).lower()
+		if name.startswith(prefix):
+			return name[len(prefix):]
+	return name
+
+
+def load_history(path=history_path):
+	"""
+	:return: list of records (time, name, key, size, fragments), oldest first
+	"""
+	if not os.path.exists(path):
+		return list()
+	with io.open(path, "r", encoding="utf-8") as f:
+		return json.load(f)
+
+
+def save_history(history, path=history_path):
+	if not os.path.exists(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with io.open(path + ".part", "w", encoding="utf-8") as f:
+		f.write(json.dumps(history, indent=1))
+	os.rename(path + ".part", path)
+
+
+def load_budgets(path):
+	"""
+	:param path: JSON file of budget key (see `budget_key()`, or "default")
+	 to maximum size (bytes, or eg. "4.5G")
+	"""
+	with io.open(path, "r", encoding="utf-8") as f:
+		budgets = json.load(f)
+	return dict((k, v if isinstance(v, int) else parse_size(v)) for k, v in budgets.items())
+
+
+def _fmt(size):
+	return "{:.1f}M".format(size / 1e6)
+
+
+def analyze(names, budgets=None, max_growth=default_max_growth, record=True, trend=5):
+	"""
+	Print the size of images per layer and per fragment, and check them
+	against budgets and their previous sizes.
+
+	:param budgets: dict of budget key to maximum size
+	:param max_growth: percentage of growth over the previous analysis
+	 considered a regression (None to not check)
+	:param record: remember the sizes in the history
+	:param trend: previous sizes to show
+	:return: list of the regressions (descriptions), empty if none
+	"""
+	history = load_history()
+	regressions = list()
+	now = time.time()
+
+	for name in names:
+		size = image_size(name)
+		if size is None:
+			logger.warning("%s doesn't exist", name)
+			continue
+		key = budget_key(name)
+		image_layers = layers(name)
+
+		per_fragment = collections.OrderedDict()
+		for layer in image_layers:
+			per_fragment[layer["fragment"]] = per_fragment.get(layer["fragment"], 0) + layer["size"]
+
+		printf("{} ({}): {}\n".format(name, key, _fmt(size)))
+		for layer in sorted(image_layers, key=lambda x: -x["size"]):
+			printf("  {:>9} {:<10} {}\n".format(_fmt(layer["size"]), layer["fragment"], layer["instruction"][:100]))
+		printf("  per fragment:\n")
+		for frag, frag_size in sorted(per_fragment.items(), key=lambda x: -x[1]):
+			printf("  {:>9} {:<10} {:>5.1f}%\n".format(_fmt(frag_size), frag, 100.0 * frag_size / max(1, size)))
+
+		previous = [x for x in history if x["key"] == key]
+		if previous:
+			printf("  previously: {}\n".format(", ".join("{} ({})".format(_fmt(x["size"]),
+			 time.strftime("%Y-%m-%d", time.localtime(x["time"]))) for x in previous[-trend:])))
+
+		budget = None
+		if budgets:
+			budget = budgets.get(key, budgets.get("default"))
+		if budget is not None and size > budget:
+			regressions.append("{} is {} over its budget of {}".format(name, _fmt(size - budget), _fmt(budget)))
+
+		if max_growth is not None and previous:
+			last = previous[-1]
+			if size > last["size"] * (1 + max_growth / 100.0):
+				grown = ", ".join("{} +{}".format(frag, _fmt(frag_size - last["fragments"].get(frag, 0)))
+				 for frag, frag_size in per_fragment.items()
+				 if frag_size > last["fragments"].get(frag, 0))
+				regressions.append("{} grew by {:.1f}% since {} ({}){}".format(name,
+				 100.0 * (size - last["size"]) / last["size"], last["name"],
+				 time.strftime("%Y-%m-%d", time.localtime(last["time"])),
+				 ": " + grown if grown else ""))
+
+		history.append(dict(time=now, name=name, key=key, size=size, fragments=per_fragment))
+
+	if record:
+		save_history(history)
+
+	for regression in regressions:
+		logger.error("%s", regression)
+
+	return regressions
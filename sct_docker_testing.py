@@ -3,9 +3,14 @@
 # Testing using Docker
 
 import sys, io, os, logging, time, datetime, shutil, datetime, subprocess
+import json, hashlib, collections
+import multiprocessing.pool
 
 import sct_docker
+import sct_docker_artifacts
+import sct_docker_trace
 from sct_docker import check_exe
+from sct_docker_build import build_images, parse_size, buildkit_available, image_id, base_digest
 
 default_distros = (
  "ubuntu:14.04",
@@ -33,8 +38,173 @@ default_commands = [
  "MPLBACKEND=Agg ${SCT_DIR}/batch_processing.sh -nodownload",
 ]
 
-def run_test(distros=None, version=None, commands=None, jobs=None):
+# Commands run in containers (see `run_tests()`); the sct_testing
+# functions are split between the shards
+default_run_commands = [
+ "f=$(ls ${SCT_DIR}/testing | sed -n -e 's/^test_\\(sct_.*\\)\\.py$/\\1/p' | awk \"(NR - 1) % ${SCT_SHARDS} == ${SCT_SHARD}\" | paste -sd, -) && [ -z \"$f\" ] || MPLBACKEND=Agg sct_testing -d 0 -f $f",
+ "MPLBACKEND=Agg ${SCT_DIR}/batch_processing.sh -nodownload",
+]
+
+
+def run_command(name, command, shard=0, shards=1, log=None):
+	"""
+	Run a command in a container of an image, in an interactive bash
+	(as the commands run during the build)
+
+	:param shard: index of the shard, given in `$SCT_SHARD`
+	:param shards: number of shards, given in `$SCT_SHARDS`
+	:param log: path of the file where to write the output
+	:return: error code
+	"""
+	cmd = [
+	 "docker", "run", "--rm",
+	 "--env", "SCT_SHARD={}".format(shard),
+	 "--env", "SCT_SHARDS={}".format(shards),
+	 "--entrypoint", "/bin/bash",
+	 name, "-i", "-c", command,
+	]
+	with io.open(log, "wb") as f:
+		return subprocess.call(cmd, stdout=f, stderr=subprocess.STDOUT)
+
+
+def run_tests(names, commands, shards=1, jobs=None):
+	"""
+	Run test commands in containers, concurrently.
+
+	The commands using `$SCT_SHARD` are run in `shards` containers,
+	the others in one. The output of each goes to
+	`<image>/test-logs/<command index>-<shard>.log`.
+
+	:param jobs: concurrent containers (default: number of CPUs)
+	:return: list of (image, command index, shard, error code, log path)
+	"""
+
+	tasks = list()
+	for name in names:
+		logs = os.path.join(name, "test-logs")
+		if os.path.exists(logs):
+			shutil.rmtree(logs)
+		os.makedirs(logs)
+		for idx_command, command in enumerate(commands):
+			n = shards if "SCT_SHARD" in command else 1
+			for shard in range(n):
+				log = os.path.join(logs, "{}-{}.log".format(idx_command, shard))
+				tasks.append((name, idx_command, command, shard, n, log))
+
+	pool = multiprocessing.pool.ThreadPool(jobs)
+
+	try:
+		promises = list()
+		for name, idx_command, command, shard, n, log in tasks:
+			promises.append(pool.apply_async(run_command, (name, command, shard, n, log)))
+
+		res = list()
+		for (name, idx_command, command, shard, n, log), promise in zip(tasks, promises):
+			err = promise.get()
+			if err == 0:
+				logging.info("%s command %d shard %d/%d passed", name, idx_command, shard, n)
+			else:
+				logging.error("%s command %d shard %d/%d failed with error code %d (see %s)",
+				 name, idx_command, shard, n, err, log)
+			res.append((name, idx_command, shard, err, log))
+
+		pool.close()
+	finally:
+		pool.terminate()
+	pool.join()
+
+	return res
+
+# Inputs of the last passing test of each distro
+passed_path = os.path.join(os.path.expanduser("~"), ".cache", "sct-docker", "test-passed.json")
+
+
+def load_passed(path=passed_path):
+	if not os.path.exists(path):
+		return dict()
+	with io.open(path, "r", encoding="utf-8") as f:
+		return json.load(f)
+
+
+def save_passed(passed, path=passed_path):
+	if not os.path.exists(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with io.open(path + ".part", "w", encoding="utf-8") as f:
+		f.write(json.dumps(passed, sort_keys=True, indent=1))
+	os.rename(path + ".part", path)
+
+
+def test_inputs(name, distro, version, commands, pinned):
 	"""
+	:param pinned: the SCT sources are identified by the Dockerfile, ie.
+	 the version is a release, or the sources come from the artifacts store
+	:return: what the result of testing a generated image depends on:
+	 SCT version, generated Dockerfile (and generation parameters), base
+	 image (see `sct_docker_build.base_digest()`) and test commands
+	"""
+	h = hashlib.sha256()
+	for filename in ("Dockerfile", "inputs.json"):
+		with io.open(os.path.join(name, filename), "rb") as f:
+			h.update(f.read())
+		h.update(b"\0")
+	return dict(
+	 version=version,
+	 pinned=pinned,
+	 dockerfile=h.hexdigest(),
+	 base=base_digest(distro),
+	 commands=hashlib.sha256(json.dumps(commands).encode("utf-8")).hexdigest(),
+	)
+
+
+def changes(inputs, passed):
+	"""
+	:param passed: inputs of the last passing test, if any
+	:return: list of reasons to test again (empty if there's none)
+	"""
+	if passed is None:
+		return ["never passed"]
+	reasons = list()
+	if inputs["version"] != passed["version"]:
+		reasons.append("SCT version changed ({} -> {})".format(passed["version"], inputs["version"]))
+	elif not inputs["pinned"]:
+		reasons.append("{} is a branch, which may have changed".format(inputs["version"]))
+	if inputs["dockerfile"] != passed["dockerfile"]:
+		reasons.append("Dockerfile changed")
+	if inputs["base"] is None:
+		reasons.append("base image can't be resolved")
+	elif inputs["base"] != passed["base"]:
+		reasons.append("base image changed")
+	if inputs["commands"] != passed["commands"]:
+		reasons.append("test commands changed")
+	return reasons
+
+
+def run_test(distros=None, version=None, commands=None, jobs=None, force=False,
+ multistage=False, cache_mounts=False, mirrors=None, artifacts_store=None,
+ cpus=None, memory=None, trace_path="build-trace.json", progress=True,
+ fail_fast=False, network_retries=3, run=False, shards=1, test_jobs=None,
+ all_distros=False):
+	"""
+	:param artifacts_store: directory where to fetch the SCT sources and
+	 datasets once, instead of downloading them in every image
+	:param mirrors: local proxy/mirrors to use during the build
+	 (see `sct_docker.generate()`)
+	:param multistage: run the commands in an image without the build tools
+	:param run: build (or reuse) an image per distro, and run the commands
+	 in containers rather than during the build (see `run_tests()`)
+	:param shards: number of containers running each sharded command
+	:param test_jobs: concurrent test containers
+	:param cache_mounts: keep downloads in BuildKit cache mounts, if available
+	:param cpus: CPU budget of the concurrent builds
+	:param memory: memory budget of the concurrent builds, in bytes
+	:param trace_path: where to write the Chrome trace of the builds
+	:param progress: show a status per image rather than the build output
+	:param fail_fast: stop all the builds as soon as one fails
+	:param network_retries: retries of builds failing on network errors
+	:param force: build (and thus test) even if an image was already
+	 successfully built from the same inputs
+	:param all_distros: test all the distros, rather than only those whose
+	 inputs changed since they last passed (see `changes()`)
 	"""
 
 	if distros is None:
@@ -44,67 +214,312 @@ def run_test(distros=None, version=None, commands=None, jobs=None):
 		version = default_version
 
 	if commands is None:
-		commands = default_commands
+		commands = default_run_commands if run else default_commands
+
+	if cache_mounts and not buildkit_available():
+		logging.warning("BuildKit is not available, not using cache mounts")
+		cache_mounts = False
+
+	artifacts = None
+	if artifacts_store and not buildkit_available():
+		# They are bind mounted in the builds
+		logging.warning("BuildKit is not available, not using the artifacts store")
+		artifacts_store = None
+	if artifacts_store:
+		artifacts = sct_docker_artifacts.populate(artifacts_store, [version], jobs=jobs)[version]
 
 	names = []
 	for distro in distros:
-		name = "sct-testing-{}-{}-{}".format(distro.replace(":", "-"), version, datetime.datetime.now().strftime("%Y%m%d%H%M%S")).lower()
+		if run:
+			name = "sct-testing-{}-{}".format(distro.replace(":", "-"), version).lower()
+		else:
+			name = "sct-testing-{}-{}-{}".format(distro.replace(":", "-"), version, datetime.datetime.now().strftime("%Y%m%d%H%M%S")).lower()
 
 		name = sct_docker.generate(
 		 distro=distro,
 		 version=version,
-		 commands=commands,
+		 commands=None if run else commands,
 		 name=name,
 		 configure_ssh=False,
 		 verbose=False,
 		 install_compilers=True,
+		 multistage=multistage,
+		 cache_mounts=cache_mounts,
+		 mirrors=mirrors,
+		 artifacts=artifacts,
 		)
 
 		names.append(name)
 
+	pinned = sct_docker_artifacts.is_release(version) or bool(artifacts)
+	passed = load_passed()
+	if not all_distros:
+		selected = list()
+		for distro, name in zip(distros, names):
+			reasons = changes(test_inputs(name, distro, version, commands, pinned), passed.get(distro))
+			if reasons:
+				print("Testing {} {}: {}".format(distro, version, ", ".join(reasons)))
+				selected.append((distro, name))
+			else:
+				print("Skipping {} {}: unchanged since it passed on {}".format(
+				 distro, version, passed[distro]["date"]))
+		distros = [distro for distro, name in selected]
+		names = [name for distro, name in selected]
+
 	print("Building images")
 
 	if not check_exe("docker"):
 		raise RuntimeError("You might want to have docker available when running this tool")
 
-	from multiprocessing.pool import ThreadPool
-	pool = ThreadPool(jobs)
-
+	# Without --run, the commands run during the build: an image found up
+	# to date isn't tested, and a branch may have moved since
+	built = set()
+	t0 = time.time()
 	try:
-		res = list()
-		for name in names:
-
-			cmd = [
-			 "docker", "build",
-			 #"--no-cache",
-			 "-t", name, name,
-			]
-
-			promise = pool.apply_async(lambda x: subprocess.call(x), (cmd,))
-			res.append(promise)
-
-		errs = list()
-		for name, promise in zip(names, res):
-			err = promise.get()
-			if err != 0:
-				logging.error("{} failed with error code {}".format(name, err))
-			errs.append(err)
-
-		pool.close()
+		errs = build_images(names, jobs=jobs, force=force or (not run and not pinned),
+		 cpus=cpus, memory=memory, progress=progress,
+		 fail_fast=fail_fast, retries=network_retries, built=built)
 	except BaseException as e:
 		print("Keyboard interrupt")
-		pool.terminate()
 		raise SystemExit(1)
-	pool.join()
+	finally:
+		sct_docker_trace.report(names, since=t0, path=trace_path)
 	print("Done building images")
 
 	for name, err in zip(names, errs):
 		if err == 0:
 			logging.info("{} finished successfully".format(name))
+		elif err is None:
+			logging.error("{} was cancelled".format(name))
 		else:
 			logging.error("{} failed with error code {}".format(name, err))
 	print(errs)
 
+	def record(distro, name):
+		# After the build, which pulled the base image if it wasn't there
+		passed[distro] = dict(test_inputs(name, distro, version, commands, pinned),
+		 date=datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
+
+	if not run:
+		for distro, name, err in zip(distros, names, errs):
+			if err == 0 and name in built:
+				record(distro, name)
+			elif err == 0:
+				print("Not recording {} {} as passed: its image was up to date, the commands didn't run".format(distro, version))
+		save_passed(passed)
+		return errs
+
+	print("Running tests")
+	built = [name for name, err in zip(names, errs) if err == 0]
+	res = run_tests(built, commands, shards=shards, jobs=test_jobs)
+	print("Done running tests")
+
+	for name, idx_command, shard, err, log in res:
+		print("{:<50} {:>3} {:>3} {:>5}  {}".format(name, idx_command, shard,
+		 "ok" if err == 0 else err, log))
+
+	for distro, name in zip(distros, names):
+		if name in built and all(err == 0 for x, idx_command, shard, err, log in res if x == name):
+			record(distro, name)
+	save_passed(passed)
+
+	return errs + [err for name, idx_command, shard, err, log in res]
+
+
+# Steps of `run_benchmark()`: dataset they use (None if none) and
+# command, run in a directory containing a copy of the dataset
+benchmark_steps = collections.OrderedDict((
+ ("check_dependencies", (None, "sct_check_dependencies -short")),
+ ("propseg", ("sct_testing_data", "sct_propseg -i sct_testing_data/t2/t2.nii.gz -c t2")),
+ ("deepseg_sc", ("sct_testing_data", "sct_deepseg_sc -i sct_testing_data/t2/t2.nii.gz -c t2")),
+ ("label_vertebrae", ("sct_testing_data", "sct_label_vertebrae -i sct_testing_data/t2/t2.nii.gz -s sct_testing_data/t2/t2_seg-manual.nii.gz -c t2")),
+ ("batch_processing", ("sct_example_data", "${SCT_DIR}/batch_processing.sh -nodownload")),
+))
+
+# Run in the containers, with the interpreter of the images, around a
+# step (its first argument): time (s), CPU time (s) and peak memory
+# (bytes, of its largest process) of the step only
+_benchmark_wrapper = """
+import sys, time, resource, subprocess
+t = time.time()
+err = subprocess.call(["/bin/bash", "-c", sys.argv[1]], stdout=sys.stderr)
+t = time.time() - t
+u = resource.getrusage(resource.RUSAGE_CHILDREN)
+print("sct-benchmark: %d %f %f %d" % (err, t, u.ru_utime + u.ru_stime, u.ru_maxrss * 1024))
+""".strip()
+
+# Results of the benchmarks, and the baseline they are compared to
+benchmark_results_path = os.path.join(os.path.expanduser("~"), ".cache", "sct-docker", "benchmark-results.json")
+benchmark_baseline_path = os.path.join(os.path.expanduser("~"), ".cache", "sct-docker", "benchmark-baseline.json")
+
+
+def run_step(name, dataset, command, log):
+	"""
+	Run a benchmark step in a container of an image, in a directory
+	containing a copy of its dataset (as downloaded in the home directory).
+	The step is measured in the container (see `_benchmark_wrapper`),
+	leaving out the container startup and the copy of the dataset.
+
+	:param dataset: name of the dataset, or None
+	:return: dict of error code, wall time, CPU time and peak memory
+	 (None when unknown, eg. if the dataset couldn't be copied)
+	"""
+	script = "[ ! -e {threads} ] || . {threads};" \
+	 " cd $(mktemp -d) && {setup}export MPLBACKEND=Agg" \
+	 " && exec \"${{PYTHON}}\" -c '{wrapper}' \"$1\" || echo \"sct-benchmark: $?\"".format(
+	 threads=sct_docker.threads_path,
+	 setup="cp -r ${{HOME}}/{0}/. {0}/ && ".format(dataset) if dataset else "",
+	 wrapper=_benchmark_wrapper)
+	cmd = ["docker", "run", "--rm", "--entrypoint", "/bin/bash", name, "-c", script, "bash", command]
+	with io.open(log, "ab") as f:
+		out = subprocess.check_output(cmd, stderr=f).decode("utf-8", "replace")
+	res = dict(err=None, wall=None, cpu=None, rss=None)
+	for line in out.splitlines():
+		if not line.startswith("sct-benchmark: "):
+			continue
+		fields = line.split()[1:]
+		try:
+			res["err"] = int(fields[0])
+			if len(fields) == 4:
+				res["wall"] = float(fields[1])
+				res["cpu"] = float(fields[2])
+				res["rss"] = int(fields[3])
+		except (IndexError, ValueError):
+			logging.warning("%s: unexpected benchmark output: %s", name, line)
+	return res
+
+
+def _load_json(path, default):
+	if not os.path.exists(path):
+		return default
+	with io.open(path, "r", encoding="utf-8") as f:
+		return json.load(f)
+
+
+def _save_json(path, data):
+	if not os.path.exists(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with io.open(path + ".part", "w", encoding="utf-8") as f:
+		f.write(json.dumps(data, sort_keys=True, indent=1))
+	os.rename(path + ".part", path)
+
+
+def _median(values):
+	values = sorted(x for x in values if x is not None)
+	if not values:
+		return None
+	return values[len(values) // 2]
+
+
+def run_benchmark(distros=None, version=None, steps=None, repeats=3,
+ jobs=None, force=False, cpus=None, memory=None, progress=True,
+ baseline_path=benchmark_baseline_path, save_baseline=False, tolerance=10):
+	"""
+	Build the testing image of each distro (as with `run_test(run=True)`),
+	then run benchmark steps in them, one container at a time, and
+	compare the median times to a baseline.
+
+	The results are appended to `benchmark_results_path`, and the output
+	of the steps goes to `<image>/benchmark.log`.
+
+	:param steps: names of `benchmark_steps` (default: all)
+	:param repeats: runs of each step
+	:param save_baseline: make these results the baseline
+	:param tolerance: percentage of slowdown over the baseline considered
+	 a regression
+	:return: list of regressions (descriptions)
+	"""
+
+	if distros is None:
+		distros = default_distros
+
+	if version is None:
+		version = default_version
+
+	if steps is None:
+		steps = list(benchmark_steps)
+
+	if not check_exe("docker"):
+		raise RuntimeError("You might want to have docker available when running this tool")
+
+	names = list()
+	for distro in distros:
+		name = "sct-testing-{}-{}".format(distro.replace(":", "-"), version).lower()
+		names.append(sct_docker.generate(
+		 distro=distro,
+		 version=version,
+		 name=name,
+		 configure_ssh=False,
+		 verbose=False,
+		 install_compilers=True,
+		))
+
+	errs = build_images(names, jobs=jobs, force=force, cpus=cpus, memory=memory,
+	 progress=progress)
+
+	baseline = _load_json(baseline_path, dict())
+	results = _load_json(benchmark_results_path, list())
+	date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+
+	rows = list()
+	for distro, name, err in zip(distros, names, errs):
+		if err != 0:
+			logging.error("%s failed to build, not benchmarking it", name)
+			continue
+		log = os.path.join(name, "benchmark.log")
+		if os.path.exists(log):
+			os.unlink(log)
+		for step in steps:
+			runs = list()
+			for idx in range(repeats):
+				logging.info("%s %s run %d/%d", name, step, idx + 1, repeats)
+				dataset, command = benchmark_steps[step]
+				runs.append(run_step(name, dataset, command, log))
+			row = dict(date=date, distro=distro, version=version, image=image_id(name),
+			 step=step, runs=runs,
+			 failed=any(x["err"] != 0 for x in runs),
+			 wall=_median(x["wall"] for x in runs),
+			 cpu=_median(x["cpu"] for x in runs),
+			 rss=_median(x["rss"] for x in runs),
+			)
+			rows.append(row)
+			results.append(row)
+
+	_save_json(benchmark_results_path, results)
+
+	regressions = list()
+	print("{:<20} {:<14} {:>9} {:>9} {:>9} {:>9}  {}".format(
+	 "step", "distro", "wall", "cpu", "peak rss", "baseline", ""))
+	for row in sorted(rows, key=lambda x: (steps.index(x["step"]), x["wall"] or 0)):
+		key = "{} {}".format(row["distro"], row["step"])
+		base = baseline.get(key)
+		note = "FAILED" if row["failed"] else ""
+		if base is not None and not row["failed"] \
+		 and row["wall"] > base["wall"] * (1 + tolerance / 100.0):
+			note = "+{:.0f}% (baseline {} {})".format(
+			 100.0 * (row["wall"] - base["wall"]) / base["wall"], base["version"], base["date"])
+			regressions.append("{} {} {}: {:.1f}s, {}".format(row["distro"], version,
+			 row["step"], row["wall"], note))
+		print("{:<20} {:<14} {:>9} {:>9} {:>9} {:>9}  {}".format(
+		 row["step"], row["distro"],
+		 "-" if row["wall"] is None else "{:.1f}s".format(row["wall"]),
+		 "-" if row["cpu"] is None else "{:.1f}s".format(row["cpu"]),
+		 "-" if row["rss"] is None else "{:.0f}M".format(row["rss"] / 1e6),
+		 "-" if base is None else "{:.1f}s".format(base["wall"]),
+		 note))
+
+	if save_baseline:
+		for row in rows:
+			if not row["failed"]:
+				baseline["{} {}".format(row["distro"], row["step"])] = dict(
+				 (k, row[k]) for k in ("date", "version", "image", "wall", "cpu", "rss"))
+		_save_json(baseline_path, baseline)
+
+	for regression in regressions:
+		logging.error("Regression: %s", regression)
+
+	return regressions
+
 if __name__ == "__main__":
 
 	import argparse
@@ -143,9 +558,186 @@ if __name__ == "__main__":
 	 default=None,
 	)
 
+	subp.add_argument("--cpus",
+	 type=int,
+	 help="CPU budget of the concurrent builds (default: number of CPUs)",
+	 default=None,
+	)
+
+	subp.add_argument("--memory",
+	 type=parse_size,
+	 metavar="SIZE",
+	 help="Memory budget of the concurrent builds (eg. 16G; default: the RAM)",
+	 default=None,
+	)
+
 	subp.add_argument("--commands",
 	 nargs="+",
-	 default=default_commands,
+	 help="Test commands (default: sct_testing and batch_processing.sh)",
+	 default=None,
+	)
+
+	subp.add_argument("--run",
+	 action="store_true",
+	 help="Run the commands in containers of a reusable image, rather than during the build",
+	 default=False,
+	)
+
+	subp.add_argument("--shards",
+	 type=int,
+	 help="With --run, number of containers running sct_testing per distro (default: %(default)s)",
+	 default=1,
+	)
+
+	subp.add_argument("--test-jobs",
+	 type=int,
+	 help="With --run, number of concurrent test containers (default: number of CPUs)",
+	 default=None,
+	)
+
+	subp.add_argument("--multistage",
+	 action="store_true",
+	 help="Run the commands in an image without the build tools",
+	 default=False,
+	)
+
+	subp.add_argument("--cache-mounts",
+	 action="store_true",
+	 help="Keep package downloads between builds (needs BuildKit)",
+	 default=False,
+	)
+
+	subp.add_argument("--mirror",
+	 action="append",
+	 type=sct_docker.parse_mirror,
+	 metavar="KIND=URL[,CA_FILE]",
+	 help="Proxy/mirror to use during the build; KIND in: {}".format(", ".join(sct_docker.mirror_kinds)),
+	 default=[],
+	)
+
+	subp.add_argument("--artifacts",
+	 dest="artifacts_store",
+	 metavar="DIR",
+	 help="Fetch the SCT sources and datasets once in this directory",
+	)
+
+	subp.add_argument("--trace",
+	 dest="trace_path",
+	 metavar="FILE",
+	 help="Where to write the Chrome trace of the builds (default: %(default)s)",
+	 default="build-trace.json",
+	)
+
+	subp.add_argument("--fail-fast",
+	 action="store_true",
+	 help="Stop all the builds as soon as one fails",
+	 default=False,
+	)
+
+	subp.add_argument("--network-retries",
+	 type=int,
+	 help="Retries of builds failing on network errors (default: %(default)s)",
+	 default=3,
+	)
+
+	subp.add_argument("--no-progress",
+	 dest="progress",
+	 action="store_false",
+	 help="Show the build output rather than a status per image (and <image>/build.log)",
+	 default=True,
+	)
+
+	subp.add_argument("--all",
+	 dest="all_distros",
+	 action="store_true",
+	 help="Test all the distros, even those whose inputs didn't change since they passed",
+	 default=False,
+	)
+
+	subp.add_argument("--force-build",
+	 dest="force",
+	 action="store_true",
+	 help="Test even if an image was built from the same inputs",
+	 default=False,
+	)
+
+	subp = subparsers.add_parser(
+	 "benchmark",
+	 help="Benchmark SCT steps in distro images",
+	)
+
+	subp.add_argument("--distros",
+	 nargs="+",
+	 help="Distributions to compare (docker image names)",
+	 default=default_distros,
+	)
+
+	subp.add_argument("--version",
+	 default=default_version,
+	)
+
+	subp.add_argument("--steps",
+	 nargs="+",
+	 choices=list(benchmark_steps),
+	 help="Steps to run (default: all)",
+	)
+
+	subp.add_argument("--repeats",
+	 type=int,
+	 help="Runs of each step (default: %(default)s)",
+	 default=3,
+	)
+
+	subp.add_argument("--jobs",
+	 type=int,
+	 default=None,
+	)
+
+	subp.add_argument("--cpus",
+	 type=int,
+	 help="CPU budget of the concurrent builds (default: number of CPUs)",
+	 default=None,
+	)
+
+	subp.add_argument("--memory",
+	 type=parse_size,
+	 metavar="SIZE",
+	 help="Memory budget of the concurrent builds (eg. 16G; default: the RAM)",
+	 default=None,
+	)
+
+	subp.add_argument("--baseline",
+	 dest="baseline_path",
+	 metavar="FILE",
+	 help="Baseline results (default: %(default)s)",
+	 default=benchmark_baseline_path,
+	)
+
+	subp.add_argument("--save-baseline",
+	 action="store_true",
+	 help="Make these results the baseline",
+	 default=False,
+	)
+
+	subp.add_argument("--tolerance",
+	 type=float,
+	 metavar="PERCENT",
+	 help="Slowdown over the baseline considered a regression (default: %(default)s)",
+	 default=10,
+	)
+
+	subp.add_argument("--no-progress",
+	 dest="progress",
+	 action="store_false",
+	 help="Show the build output rather than a status per image (and <image>/build.log)",
+	 default=True,
+	)
+
+	subp.add_argument("--force-build",
+	 dest="force",
+	 action="store_true",
+	 help="Build even if the images are up to date",
+	 default=False,
 	)
 
 	try:
@@ -159,7 +751,24 @@ if __name__ == "__main__":
 	if args.command == "test":
 
 		res = run_test(distros=args.distros, version=args.version,
-		 commands=args.commands, jobs=args.jobs)
+		 commands=args.commands, jobs=args.jobs, force=args.force,
+		 multistage=args.multistage, cache_mounts=args.cache_mounts,
+		 mirrors=dict(args.mirror), artifacts_store=args.artifacts_store,
+		 cpus=args.cpus, memory=args.memory, trace_path=args.trace_path,
+		 progress=args.progress,
+		 fail_fast=args.fail_fast, network_retries=args.network_retries,
+		 run=args.run, shards=args.shards, test_jobs=args.test_jobs,
+		 all_distros=args.all_distros)
+
+	elif args.command == "benchmark":
+
+		regressions = run_benchmark(distros=args.distros, version=args.version,
+		 steps=args.steps, repeats=args.repeats, jobs=args.jobs, force=args.force,
+		 cpus=args.cpus, memory=args.memory, progress=args.progress,
+		 baseline_path=args.baseline_path, save_baseline=args.save_baseline,
+		 tolerance=args.tolerance)
+		if regressions:
+			raise SystemExit(1)
 
 	else:
 		parser.print_help(sys.stderr)
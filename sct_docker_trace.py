@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 vi:noet
+# Per-step timing of image builds
+
+import sys, io, os, re, json, logging, time, subprocess
+import collections
+
+from sct_docker import printf
+
+logger = logging.getLogger(__name__)
+
+
+# Where the steps of a build are saved, in the image directory
+trace_filename = "build-trace.json"
+
+
+class BuildTrace(object):
+	"""
+	Timing of the steps of a build, parsed from the `docker build` output
+	(classic builder, or BuildKit with plain progress).
+
+	Each step is a dict with: instruction, start/end (epoch seconds),
+	cached, layer (ID, classic builder only) and size (bytes, once
+	`finish()` is called).
+	"""
+	def __init__(self, name):
+		self.name = name
+		self.start = time.time()
+		self.end = None
+		self.steps = list()
+		self.current = None # classic builder step being run
+		self.vertices = dict() # BuildKit steps by vertex number
+
+	def _end_current(self, now):
+		if self.current is not None and self.current["end"] is None:
+			self.current["end"] = now
+
+	def feed(self, line, now=None):
+		if now is None:
+			now = time.time()
+		line = line.rstrip("\n")
+
+		m = re.match(r"^Step (?P<n>\d+)/\d+ : (?P<instruction>.*)$", line)
+		if m is not None:
+			self._end_current(now)
+			self.current = dict(instruction=m.group("instruction"),
+			 start=now, end=None, cached=False, layer=None, size=None)
+			self.steps.append(self.current)
+			return
+
+		if self.current is not None:
+			if line.startswith(" ---> Using cache"):
+				self.current["cached"] = True
+				return
+			m = re.match(r"^ ---> (?P<id>[0-9a-f]{12})$", line)
+			if m is not None:
+				self.current["layer"] = m.group("id")
+				self._end_current(now)
+				return
+
+		m = re.match(r"^#(?P<n>\d+) (?P<rest>.*)$", line)
+		if m is None:
+			return
+		n, rest = m.group("n"), m.group("rest")
+		m = re.match(r"^\[(?P<stage>[^\]]+)\] (?P<instruction>.*)$", rest)
+		if m is not None and n not in self.vertices:
+			if m.group("stage") == "internal":
+				return
+			step = dict(instruction=m.group("instruction"), stage=m.group("stage"),
+			 start=now, end=None, cached=False, layer=None, size=None)
+			self.vertices[n] = step
+			self.steps.append(step)
+			return
+		step = self.vertices.get(n)
+		if step is None:
+			return
+		if rest == "CACHED":
+			step["cached"] = True
+			step["end"] = now
+		elif rest.startswith(("DONE", "ERROR")):
+			step["end"] = now
+
+	def finish(self, now=None):
+		"""
+		Close the trace, and get the layer sizes from the image history
+		"""
+		if now is None:
+			now = time.time()
+		self.end = now
+		for step in self.steps:
+			if step["end"] is None:
+				step["end"] = now
+
+		cmd = ["docker", "history", "--no-trunc", "--human=false", "--format", "{{.ID}}\t{{.CreatedBy}}\t{{.Size}}", self.name]
+		try:
+			out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode("utf-8", "replace")
+		except (subprocess.CalledProcessError, OSError):
+			return
+		history = [x.split("\t") for x in out.splitlines() if x.count("\t") == 2]
+
+		sizes = dict()
+		for layer, created_by, size in history:
+			if size.isdigit():
+				sizes[layer] = int(size)
+
+		unused = list(reversed(history))
+		for step in self.steps:
+			for layer, size in sizes.items():
+				if step["layer"] is not None and layer.split(":")[-1].startswith(step["layer"]):
+					step["size"] = size
+					break
+			if step["size"] is not None or not step["instruction"].startswith("RUN "):
+				continue
+			# BuildKit doesn't tell the layer ID, match on the command
+			command = step["instruction"][4:]
+			for row in unused:
+				if command in row[1]:
+					if row[2].isdigit():
+						step["size"] = int(row[2])
+					unused.remove(row)
+					break
+
+	def to_dict(self):
+		return dict(name=self.name, start=self.start, end=self.end, steps=self.steps)
+
+	def save(self):
+		path = os.path.join(self.name, trace_filename)
+		with io.open(path, "w", encoding="utf-8") as f:
+			f.write(json.dumps(self.to_dict(), indent=1))
+
+
+def load_traces(names, since=None):
+	"""
+	:param since: only the traces of builds started after this time
+	:return: list of traces (as dicts)
+	"""
+	traces = list()
+	for name in names:
+		path = os.path.join(name, trace_filename)
+		if not os.path.exists(path):
+			continue
+		with io.open(path, "r", encoding="utf-8") as f:
+			trace = json.load(f)
+		if since is None or trace["start"] >= since:
+			traces.append(trace)
+	return traces
+
+
+def write_chrome_trace(traces, path):
+	"""
+	Save traces in the Chrome trace event format (chrome://tracing,
+	https://ui.perfetto.dev), one row per image.
+	"""
+	if not traces:
+		return
+	t0 = min(x["start"] for x in traces)
+	events = list()
+	for tid, trace in enumerate(traces):
+		events.append(dict(ph="M", pid=0, tid=tid, name="thread_name",
+		 args=dict(name=trace["name"])))
+		events.append(dict(ph="X", pid=0, tid=tid, name=trace["name"],
+		 ts=int((trace["start"] - t0) * 1e6),
+		 dur=int(((trace["end"] or trace["start"]) - trace["start"]) * 1e6)))
+		for step in trace["steps"]:
+			events.append(dict(ph="X", pid=0, tid=tid,
+			 name=step["instruction"][:100],
+			 cat="cached" if step["cached"] else "built",
+			 ts=int((step["start"] - t0) * 1e6),
+			 dur=int((step["end"] - step["start"]) * 1e6),
+			 args=dict(instruction=step["instruction"], cached=step["cached"], size=step["size"]),
+			))
+	with io.open(path, "w", encoding="utf-8") as f:
+		f.write(json.dumps(dict(traceEvents=events, displayTimeUnit="ms")))
+
+
+def print_summary(traces, count=20):
+	"""
+	Print the slowest steps (that were not cached), across images
+	"""
+	steps = collections.defaultdict(list)
+	for trace in traces:
+		for step in trace["steps"]:
+			if step["cached"]:
+				continue
+			steps[step["instruction"]].append((step["end"] - step["start"], trace["name"], step["size"]))
+
+	rows = list()
+	for instruction, runs in steps.items():
+		total = sum(x[0] for x in runs)
+		slowest = max(runs, key=lambda x: x[0])
+		rows.append((total, len(runs), slowest, instruction))
+	rows.sort(key=lambda x: -x[0])
+
+	printf("{:>8} {:>4} {:>8} {:>9}  {:<30} {}\n".format(
+	 "total", "n", "max", "size", "slowest in", "instruction"))
+	for total, n, (duration, name, size), instruction in rows[:count]:
+		printf("{:>7.0f}s {:>4} {:>7.0f}s {:>9}  {:<30} {}\n".format(
+		 total, n, duration,
+		 "-" if size is None else "{:.1f}M".format(size / 1e6),
+		 name, instruction[:80]))
+
+
+def report(names, since=None, path=None):
+	"""
+	Write the Chrome trace of the builds of a run, and print their
+	slowest steps.
+
+	:param since: start time of the run
+	:param path: where to write the Chrome trace
+	"""
+	traces = load_traces(names, since=since)
+	if not traces:
+		return
+	if path is not None:
+		write_chrome_trace(traces, path)
+		logger.info("Build trace written to %s", path)
+	print_summary(traces)